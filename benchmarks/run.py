@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import config
+from benchmarks.synthetic import generate
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# stages in the order they depend on each other, each one runs on the outputs of the stages before it
+stages = ["reduce", "pointclouds", "ransac", "masks", "clean"]
+
+
+def run_stage(stage, folder, jobs):
+    if stage == "reduce":
+        from step2_reduce_data import reduce_folder
+        reduce_folder(folder, jobs=jobs)
+    elif stage == "pointclouds":
+        from step3_calculate_pointclouds import calculate_pointclouds
+        calculate_pointclouds(folder, jobs)
+    elif stage == "ransac":
+        from step4_ransac import calculate_ransac
+        calculate_ransac(folder)
+    elif stage == "masks":
+        from step5_create_mask import calculate_masks
+        calculate_masks(folder, jobs)
+    elif stage == "clean":
+        from step6_connected_components import clean_cc
+        clean_cc([folder], jobs)
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on linux, the peak of the pool workers is included with the children
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.
+
+
+def measure(args):
+    # runs in its own process so the peak memory is the one of this stage only
+    config.color_width = config.ir_width = args.width
+    config.color_height = config.ir_height = args.height
+    config.segmenter_backend = args.segmenter
+
+    start = time.perf_counter()
+    run_stage(args.stage, args.folder, args.jobs)
+    seconds = time.perf_counter() - start
+
+    print(json.dumps({"seconds": seconds, "fps": args.frames / seconds, "peak_rss_mb": peak_rss()}))
+
+
+def benchmark(args):
+    directory = args.directory or tempfile.mkdtemp(prefix="groundsegmentation_benchmark_")
+    folder = os.path.join(directory, "benchmark")
+    print("generating {} frames of {}x{} in {}".format(args.frames, args.width, args.height, folder))
+    generate(folder, args.frames, args.width, args.height, args.boxes)
+
+    results = {}
+    try:
+        for stage in stages:
+            command = [sys.executable, "-m", "benchmarks.run", "--measure", stage, "--directory", directory,
+                       "--frames", str(args.frames), "--width", str(args.width), "--height", str(args.height),
+                       "--segmenter", args.segmenter]
+            if args.jobs:
+                command += ["--jobs", str(args.jobs)]
+
+            output = subprocess.run(command, cwd=root, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+            results[stage] = json.loads(output.stdout.splitlines()[-1])
+            print("{:12} {:8.2f} frames/s {:8.1f} MB peak".format(
+                stage, results[stage]["fps"], results[stage]["peak_rss_mb"]))
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # a stage regressed when it is slower or uses more memory than the baseline by more than tolerance
+    regressions = []
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        old = baseline[stage]
+        if result["fps"] < old["fps"] * (1 - tolerance):
+            regressions.append("{}: {:.2f} frames/s, baseline {:.2f}".format(stage, result["fps"], old["fps"]))
+        if result["peak_rss_mb"] > old["peak_rss_mb"] * (1 + tolerance):
+            regressions.append("{}: {:.1f} MB peak, baseline {:.1f}".format(
+                stage, result["peak_rss_mb"], old["peak_rss_mb"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=50)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=360)
+    parser.add_argument("--boxes", type=int, default=3)
+    parser.add_argument("--jobs", type=int, default=config.jobs, help="number of worker processes of the stages")
+    parser.add_argument("--segmenter", default="numpy", help="segmenter_backend used by the ransac stage")
+    parser.add_argument("--directory", help="where the synthetic dataset is written, a temporary folder if not set")
+    parser.add_argument("--keep", action="store_true", help="keep the synthetic dataset and the stage outputs")
+    parser.add_argument("--save", help="write the results as json to this file, e.g. to use them as baseline")
+    parser.add_argument("--baseline", help="compare against the results of an earlier run saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown / memory growth")
+    parser.add_argument("--measure", choices=stages, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        args.stage, args.folder = args.measure, os.path.join(args.directory, "benchmark")
+        measure(args)
+        exit(0)
+
+    results = benchmark(args)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for x in regressions:
+            print("regression", x)
+        if regressions:
+            exit(1)
@@ -0,0 +1,96 @@
+import argparse
+import os
+import pickle
+
+import numpy as np
+
+# size in meters of one texel of the ground and box textures
+texel_size = 0.02
+
+
+def texture(rng, size=256):
+    return rng.integers(40, 220, size=(size, size)).astype(np.uint8)
+
+
+def sample(tex, a, b):
+    return tex[(np.floor(a / texel_size) % tex.shape[0]).astype(int),
+               (np.floor(b / texel_size) % tex.shape[1]).astype(int)]
+
+
+def render(width, height, f, origin, boxes, tex, camera_height, shift):
+    # rectified view of a camera at x = origin, camera_height above a textured ground plane, which moved
+    # shift meters forward. The boxes are drawn with their textured front faces
+    u, v = np.meshgrid(np.arange(width, dtype=np.float64), np.arange(height, dtype=np.float64))
+    dx, dy = (u - width / 2.) / f, (v - height / 2.) / f
+    depth = np.full(u.shape, np.inf)
+    image = np.full(u.shape, 20, dtype=np.uint8)
+
+    with np.errstate(divide="ignore"):
+        t = np.where(dy > 0, camera_height / np.maximum(dy, 0), np.inf)
+    hit = np.isfinite(t)
+    image[hit] = sample(tex, origin + dx[hit] * t[hit], t[hit] + shift)
+    depth[hit] = t[hit]
+
+    for x0, x1, z, size in boxes:
+        t = z - shift
+        x, y = origin + dx * t, dy * t
+        hit = (t > 0) & (x >= x0) & (x <= x1) & (y >= camera_height - size) & (y <= camera_height) & (t < depth)
+        image[hit] = sample(tex, x[hit], y[hit]) // 2 + 100
+        depth[hit] = t
+    return image
+
+
+def write_calibration(common, width, height, f, baseline):
+    os.makedirs(common, exist_ok=True)
+
+    K = [f, 0., width / 2., 0., f, height / 2., 0., 0., 1.]
+    for x in ["depth", "color", "infra1", "infra2"]:
+        info = {"height": height, "width": width, "distortion_model": "plumb_bob", "D": [0.] * 5, "K": K,
+                "R": [1., 0., 0., 0., 1., 0., 0., 0., 1.], "P": K[:3] + [0.] + K[3:6] + [0.] + K[6:] + [0.],
+                "binning_x": 0, "binning_y": 0}
+        with open(os.path.join(common, "camera_{}.pkl".format(x)), "wb") as file:
+            pickle.dump(info, file)
+
+    # color and infra1 share the depth camera's frame, infra2 is the right camera of the stereo pair
+    for x, tx in [("depth_to_color", 0.), ("depth_to_infra1", 0.), ("depth_to_infra2", -baseline)]:
+        extrinsic = {"name": x, "rotation": [1., 0., 0., 0., 1., 0., 0., 0., 1.], "translation": [tx, 0., 0.]}
+        with open(os.path.join(common, "extrinsic_{}.pkl".format(x)), "wb") as file:
+            pickle.dump(extrinsic, file)
+
+
+def generate(folder, frames=20, width=320, height=180, boxes=3, baseline=0.05, speed=0.05, seed=0):
+    # writes color.npy, infra1.npy and infra2.npy of a camera moving speed meters per frame over the
+    # ground towards the boxes, and the calibration into the common folder next to the dataset
+    rng = np.random.default_rng(seed)
+    f = 0.8 * width
+    os.makedirs(folder, exist_ok=True)
+    write_calibration(os.path.join(folder, "..", "common"), width, height, f, baseline)
+
+    tex = texture(rng)
+    obstacles = []
+    for x in range(boxes):
+        x0 = rng.uniform(-2, 1)
+        obstacles.append((x0, x0 + rng.uniform(0.3, 1), rng.uniform(2, 6), rng.uniform(0.2, 0.6)))
+
+    infra1 = np.ndarray(shape=(frames, height, width), dtype=np.uint8)
+    infra2 = np.ndarray(shape=(frames, height, width), dtype=np.uint8)
+    for i in range(frames):
+        infra1[i] = render(width, height, f, 0., obstacles, tex, 0.5, i * speed)
+        infra2[i] = render(width, height, f, baseline, obstacles, tex, 0.5, i * speed)
+    color = np.stack([infra1, infra1 // 2 + 60, 255 - infra1], axis=-1)
+
+    np.save(os.path.join(folder, "infra1.npy"), infra1)
+    np.save(os.path.join(folder, "infra2.npy"), infra2)
+    np.save(os.path.join(folder, "color.npy"), color)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder")
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("--width", type=int, default=320)
+    parser.add_argument("--height", type=int, default=180)
+    parser.add_argument("--boxes", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate(args.folder, args.frames, args.width, args.height, args.boxes, seed=args.seed)
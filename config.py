@@ -4,6 +4,20 @@ color_width = 1280
 color_height = 720
 ir_width = 1280
 ir_height = 720
+# number of worker processes used by the steps, None uses all cores
+jobs = None
+# zlib level of the written png files and number of images which may wait for the background writer
+png_compression = 3
+writer_queue_size = 16
+# append the timings of the phases, counts and memory of every frame of a step to trace.jsonl in the
+# dataset folder. trace_profile additionally runs the steps under cProfile and writes <stage>.prof
+trace_enabled = True
+trace_profile = False
+# "npy" writes the arrays of the steps as .npy files, "hdf5" as .h5 files chunked per frame and compressed
+# with hdf5_compression, "lzf" or "blosc" (needs the hdf5plugin package, lzf is used without it) or None.
+# Arrays are read in the format they were written in
+storage_backend = "npy"
+hdf5_compression = "lzf"
 
 # Step 1
 topic_infra1 = "/camera/infra1/image_rect_raw"
@@ -15,9 +29,21 @@ bagfile_folder = "/home/user/Documents/"
 debug_step2 = False
 change_threshold = 10
 sharpest_frame_batch_size = 15
+# frames compared to the last selected frame at once while searching the next changed frame
+change_window = 64
+# frames per task when scoring the frames of a chunk in the worker pool
+score_batch_size = 64
+# combine the chunks of a recording into a virtual dataset which references the reduced chunks
+# instead of copying them into one file
+combine_virtual = False
 
 # Step 3
 debug_step3 = False
+# frames per task handed to a stereo worker
+stereo_batch_size = 4
+# "disparity" stores the int16 fixed point disparity maps and the Q matrix, the pointclouds are
+# reprojected when they are read. "coords" stores dense float32 pointclouds of shape N x (W*H) x 3
+pointcloud_storage = "disparity"
 
 
 def get_stereo():
@@ -30,17 +56,42 @@ def get_stereo():
 
 # Step 4
 debug_step4 = False
+ransac_distance_threshold = 0.03
+# start each frame from the plane of the previous frame and only run the full segmentation when the
+# plane explains less than tracking_min_inlier_ratio of the inliers of the last fully segmented frame.
+# The inliers of tracked frames are only based on the distance to the plane
+ransac_tracking = False
+tracking_min_inlier_ratio = 0.9
+# leaf size in meters of the voxel grid the plane is segmented on, the full resolution pointcloud is then
+# classified against that plane. None segments the full resolution pointcloud
+voxel_leaf_size = None
+# store the inlier maps bit packed in good_idx_packed.npy instead of one bool per point in good_idx.npy
+pack_inliers = True
 
 
-def make_segmenter(p):
+# "pcl" segments with python-pcl's normal plane model, "numpy" with the batched RANSAC from utils.plane
+segmenter_backend = "pcl"
+
+
+def make_segmenter(coords):
+    if segmenter_backend == "numpy":
+        from utils.plane import PlaneSegmenter
+        seg = PlaneSegmenter(coords)
+        seg.set_optimize_coefficients(True)
+        seg.set_max_iterations(200)
+        seg.set_sample_count(20000)
+        seg.set_distance_threshold(ransac_distance_threshold)
+        return seg
+
     import pcl
+    p = pcl.PointCloud(coords)
     seg = p.make_segmenter_normals(ksearch=20)
     seg.set_optimize_coefficients(True)
     seg.set_model_type(pcl.SACMODEL_NORMAL_PLANE)
     seg.set_normal_distance_weight(0.03)
     seg.set_method_type(pcl.SAC_RANSAC)
     seg.set_max_iterations(50)
-    seg.set_distance_threshold(0.03)
+    seg.set_distance_threshold(ransac_distance_threshold)
     return seg
 
 
@@ -50,11 +101,61 @@ debug_step5 = False
 crf_inference_count = 9
 crf_label_gt_prob = 0.7
 
-def configure_crf(d, color_image):
-    d.addPairwiseGaussian(sxy=6, compat=10)
-    d.addPairwiseBilateral(sxy=10, srgb=13, rgbim=color_image, compat=10)
+# "full" runs the crf on the whole image, "downscale" on the image scaled by crf_downscale and "band"
+# only on the tiles around label transitions, everywhere else the labels are taken as they are
+crf_mode = "full"
+crf_downscale = 0.5
+crf_band_width = 16
+crf_tile_size = 128
+# additionally run the full crf and report how many labeled pixels the chosen mode agrees on
+crf_report_agreement = False
+
+
+def configure_crf(d, color_image, scale=1.):
+    d.addPairwiseGaussian(sxy=6 * scale, compat=10)
+    d.addPairwiseBilateral(sxy=10 * scale, srgb=13, rgbim=color_image, compat=10)
 
 
 # Step 6
 debug_step6 = False
 min_obstacle_pixel_count = 5000
+# clean the connected components directly in step 5 and write label_clean there, the label folder is
+# only written if fused_write_label is set
+fuse_clean = False
+fused_write_label = True
+
+
+# Step 7
+# frames before and after the current one which are loaded in the background, and number of frames
+# whose views are kept in memory
+review_prefetch = 4
+review_cache_size = 32
+
+
+# Step 8
+# the good frames are packed into tar shards of export_shard_frames frames in export_directory, resized to
+# export_size (width, height) if it is set
+export_directory = "/data/export/"
+export_shard_frames = 1000
+export_size = None
+
+
+# Evaluation
+# label folders compared by evaluate.py as (prediction, reference) pairs. label_gt holds hand labeled ground
+# truth, either as indexed png like the labels of step 5 or with green ground and red obstacles
+evaluation_pairs = [("label", "label_gt"), ("label_clean", "label_gt"), ("label", "label_clean")]
+
+
+# Pipeline runner
+# cores and memory in GB all stages running at the same time may use, None uses all cores
+runner_cpus = None
+runner_memory = 32
+# estimated memory in GB of one worker process of each stage
+runner_memory_per_job = {
+    "extract": 4,
+    "reduce": 1,
+    "pointclouds": 0.5,
+    "ransac": 3,
+    "masks": 1.5,
+    "clean": 0.3
+}
@@ -0,0 +1,103 @@
+import argparse
+import glob
+import json
+import os
+from collections import defaultdict
+
+import numpy as np
+from PIL import Image
+
+import config
+from utils import parallel
+from utils.image import confusion, dice_score, iou
+from utils.reader import Labels
+
+
+def read_label(path):
+    # class indices of a label png, None if the frame has no such label
+    if not os.path.exists(path):
+        return None
+
+    image = Image.open(path)
+    if image.mode == "P":
+        # written by step 5 and 6, the palette index is the class
+        return np.asarray(image)
+
+    # any other png is read by its colors, green is ground and red is an obstacle
+    rgb = np.asarray(image.convert("RGB"))
+    label = np.full(rgb.shape[:2], 255, dtype=np.uint8)
+    label[rgb[..., 1] == 255] = 0
+    label[rgb[..., 0] == 255] = 1
+    return label
+
+
+def evaluate_frame(task):
+    # confusion matrices of all pairs of folders of one frame, pixels the reference does not label are ignored
+    folder, name = task
+    labels = {}
+    for x in {x for pair in config.evaluation_pairs for x in pair}:
+        labels[x] = read_label(os.path.join(folder, x, name))
+
+    matrices = {}
+    for prediction, reference in config.evaluation_pairs:
+        if labels[prediction] is None or labels[reference] is None:
+            continue
+        matrices[prediction, reference] = confusion(labels[reference], labels[prediction], labels[reference] > 1)
+    return folder, name, matrices
+
+
+def scores(matrix):
+    pixels = max(matrix.sum(), 1)
+    return {
+        "iou": iou(matrix).tolist(),
+        "dice": dice_score(matrix).tolist(),
+        # share of the evaluated pixels which the prediction labeled at all
+        "coverage": matrix[:, :-1].sum() / pixels
+    }
+
+
+def report(title, matrices):
+    print(title)
+    for (prediction, reference), matrix in sorted(matrices.items()):
+        result = scores(matrix)
+        print("  {:>12} vs {:<12} iou ground {:.3f} obstacle {:.3f}  dice ground {:.3f} obstacle {:.3f}  "
+              "coverage {:.2%}".format(prediction, reference, *result["iou"], *result["dice"], result["coverage"]))
+
+
+def evaluate(names, jobs=None):
+    # only the frames reviewed as good are evaluated
+    tasks = []
+    for name in names:
+        good, _ = Labels(name).load_good_bad_index()
+        tasks += [(name, x) for x in sorted(good)]
+
+    totals = defaultdict(lambda: 0)
+    datasets = defaultdict(lambda: defaultdict(lambda: 0))
+    frames = defaultdict(list)
+    for folder, name, matrices in parallel.imap(evaluate_frame, tasks, jobs or config.jobs, chunksize=16):
+        record = {"name": name}
+        for pair, matrix in matrices.items():
+            datasets[folder][pair] = datasets[folder][pair] + matrix
+            totals[pair] = totals[pair] + matrix
+            record[" vs ".join(pair)] = scores(matrix)
+        frames[folder].append(record)
+
+    # the per frame scores are written next to the labels, the datasets and the total are printed
+    for folder in names:
+        with open(os.path.join(folder, "evaluation.jsonl"), "w") as f:
+            f.writelines(json.dumps(x) + "\n" for x in frames[folder])
+        report("{} ({} frames)".format(folder, len(frames[folder])), datasets[folder])
+    report("total ({} frames)".format(len(tasks)), totals)
+
+
+def find_labeled():
+    folders = glob.glob(os.path.join(config.data_directory, "**/label_clean"))
+    return sorted(os.path.dirname(x) for x in folders)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("datasets", nargs="*", help="dataset folders, all cleaned datasets if not given")
+    parser.add_argument("--jobs", type=int, default=config.jobs, help="number of evaluation worker processes")
+    args = parser.parse_args()
+    evaluate(args.datasets or find_labeled(), args.jobs)
@@ -0,0 +1,154 @@
+import argparse
+import glob
+import multiprocessing
+import os
+from collections import defaultdict
+from multiprocessing.connection import wait
+from types import SimpleNamespace
+
+import config
+from step2_reduce_data import find_chunks, recording_name
+from utils import cache, parallel, storage
+
+# stages of a dataset in the order they depend on each other
+stages = ["extract", "reduce", "pointclouds", "ransac", "masks", "clean"]
+
+# stages which run in a single process, all others distribute their frames over worker processes
+single_job_stages = {"extract", "ransac"}
+
+
+def chunk_folder(bag):
+    # same naming as step1_bagfile.bag_name_to_filename
+    return os.path.join(config.data_directory,
+                        bag.replace(config.bagfile_folder, "").replace("/", "_").replace(".bag", ""))
+
+
+def run_stage(stage, target, jobs):
+    # the steps are imported here, so only the dependencies of the stages which run are needed
+    if stage == "extract":
+        from step1_bagfile import Extract
+        Extract(bag=target, to=chunk_folder(target)).extract()
+    elif stage == "reduce":
+        from step2_reduce_data import reduce_chunks
+        reduce_chunks(target, jobs)
+    elif stage == "pointclouds":
+        from step3_calculate_pointclouds import calculate_pointclouds
+        calculate_pointclouds(target, jobs)
+    elif stage == "ransac":
+        from step4_ransac import calculate_ransac
+        calculate_ransac(target)
+    elif stage == "masks":
+        from step5_create_mask import calculate_masks
+        calculate_masks(target, jobs)
+    elif stage == "clean":
+        from step6_connected_components import clean_cc
+        clean_cc([target], jobs)
+
+
+def task(stage, dataset, target, deps=()):
+    return SimpleNamespace(stage=stage, dataset=dataset, target=target, deps=list(deps), jobs=0, process=None)
+
+
+def plan():
+    bags = defaultdict(list)
+    for bag in sorted(glob.glob(os.path.join(config.bagfile_folder, "**/*.bag"))):
+        bags[recording_name(chunk_folder(bag))].append(bag)
+
+    chunks = defaultdict(list)
+    for chunk in find_chunks():
+        chunks[recording_name(chunk)].append(chunk)
+
+    all_chunks = {x for c in chunks.values() for x in c}
+    datasets = set(bags) | set(chunks) | (set(storage.find(config.data_directory, "color")) - all_chunks)
+
+    tasks = []
+    for dataset in sorted(datasets):
+        previous = []
+        if not cache.is_fresh("reduce", dataset):
+            extracts = [task("extract", dataset, bag) for bag in bags[dataset] if not os.path.exists(chunk_folder(bag))]
+            targets = sorted(set(chunks[dataset]) | {chunk_folder(bag) for bag in bags[dataset]})
+            previous = [task("reduce", dataset, targets, extracts)]
+            tasks += extracts + previous
+
+        for stage in stages[2:]:
+            # step 5 already cleans the masks
+            if stage == "clean" and config.fuse_clean:
+                continue
+            # a stage reruns when it is stale or when the stage before it runs
+            if previous or not cache.is_fresh(stage, dataset):
+                previous = [task(stage, dataset, dataset, previous)]
+                tasks += previous
+    return tasks
+
+
+def allocate(task, ready_count, free_cpus, free_memory, idle):
+    # parallel stages get an equal share of the free cores, limited by the memory their workers need
+    wanted = 1 if task.stage in single_job_stages else parallel.job_count(config.jobs)
+    jobs = min(wanted, max(free_cpus // ready_count, 1), free_cpus,
+               int(free_memory // config.runner_memory_per_job[task.stage]))
+
+    # with nothing running a stage is started even if it exceeds the budget
+    if jobs < 1 and idle:
+        jobs = 1
+    return jobs
+
+
+def run(tasks, cpus=None, memory=None):
+    cpus = parallel.job_count(cpus or config.runner_cpus)
+    memory = memory or config.runner_memory
+    free_cpus, free_memory = cpus, memory
+    pending, running, finished, failed = list(tasks), {}, set(), set()
+
+    while pending or running:
+        for x in [x for x in pending if any(id(d) in failed for d in x.deps)]:
+            print("skipping", x.stage, "for", x.dataset, "after a failed stage")
+            pending.remove(x)
+            failed.add(id(x))
+
+        # later stages first, so datasets are completed before the next ones are started
+        ready = [x for x in pending if all(id(d) in finished for d in x.deps)]
+        ready.sort(key=lambda x: -stages.index(x.stage))
+        for n, x in enumerate(ready):
+            # the cores still free are shared by this stage and the ready stages after it
+            x.jobs = allocate(x, len(ready) - n, free_cpus, free_memory, idle=not running)
+            if x.jobs < 1:
+                continue
+
+            print("starting", x.stage, "for", x.dataset, "with", x.jobs, "jobs")
+            x.process = multiprocessing.Process(target=run_stage, args=(x.stage, x.target, x.jobs))
+            x.process.start()
+            pending.remove(x)
+            running[x.process.sentinel] = x
+            free_cpus -= x.jobs
+            free_memory -= x.jobs * config.runner_memory_per_job[x.stage]
+
+        if not running:
+            continue
+
+        for sentinel in wait(list(running)):
+            x = running.pop(sentinel)
+            x.process.join()
+            free_cpus += x.jobs
+            free_memory += x.jobs * config.runner_memory_per_job[x.stage]
+            if x.process.exitcode == 0:
+                finished.add(id(x))
+            else:
+                print("failed", x.stage, "for", x.dataset, "with exit code", x.process.exitcode)
+                failed.add(id(x))
+
+    return not failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cpus", type=int, default=config.runner_cpus, help="cores used by all stages together")
+    parser.add_argument("--memory", type=float, default=config.runner_memory, help="memory budget in GB")
+    parser.add_argument("--dry-run", action="store_true", help="only list the stages which would run")
+    args = parser.parse_args()
+
+    tasks = plan()
+    if args.dry_run:
+        for x in tasks:
+            print(x.stage, x.target)
+    elif not run(tasks, args.cpus, args.memory):
+        exit(1)
@@ -3,12 +3,13 @@ from __future__ import print_function, unicode_literals
 import glob
 import os
 import pickle
+from collections import deque
 
-import numpy as np
 import rosbag
 from cv_bridge import CvBridge
 
 import config
+from utils import storage, trace
 
 
 class Extract:
@@ -75,39 +76,54 @@ class Extract:
     def extract_sync_images(self):
         bridge = CvBridge()
         topics = [config.topic_infra1, config.topic_infra2, config.topic_color]
-        frames = {t: {} for t in topics}
-        for topic, msg, t in self.bag.read_messages(topics):
-            time = msg.header.stamp.secs + float(msg.header.stamp.nsecs) / 1.e9
-            frames[topic][time] = bridge.imgmsg_to_cv2(msg)
-
-        times = {t: np.array(list(frames[t].keys()), dtype=np.float64) for t in topics}
-
-        matched_ir1 = []
-        matched_ir2 = []
-        matched_color = []
-
-        for i, t in enumerate(sorted(times[config.topic_infra1])):
-            if t in frames[config.topic_infra2] and t in frames[config.topic_color]:
-                matched_ir1.append(frames[config.topic_infra1][t])
-                matched_ir2.append(frames[config.topic_infra2][t])
-                matched_color.append(frames[config.topic_color][t])
-
-        print("found {} matching paris of {} total frames".format(len(matched_color), len(times[config.topic_infra1])))
-        np_images = np.array(matched_ir1)
-        np_images.dump(self.outpath("infra1", ext="npy"))
-        np_images = np.array(matched_ir2)
-        np_images.dump(self.outpath("infra2", ext="npy"))
-        np_images = np.array(matched_color)
-        np_images.dump(self.outpath("color", ext="npy"))
+
+        # messages of each topic arrive ordered by their header stamp, so the frames are matched with a
+        # merge-join over small per-topic queues and written out as soon as all three stamps agree
+        pending = {t: deque() for t in topics}
+        total = 0
+        read = 0.
+        with storage.writer(self.path, "infra1") as infra1, \
+                storage.writer(self.path, "infra2") as infra2, \
+                storage.writer(self.path, "color") as color, \
+                trace.TraceWriter(self.path, "extract") as tracer:
+            outputs = {config.topic_infra1: infra1, config.topic_infra2: infra2, config.topic_color: color}
+            last = trace.clock()
+            for topic, msg, t in self.bag.read_messages(topics):
+                read += trace.clock() - last
+                if topic == config.topic_infra1:
+                    total += 1
+                pending[topic].append(((msg.header.stamp.secs, msg.header.stamp.nsecs), msg))
+
+                while all(pending.values()):
+                    latest = max(pending[x][0][0] for x in topics)
+                    if all(pending[x][0][0] == latest for x in topics):
+                        frame = trace.Trace("extract", color.count)
+                        frame.add("read", read)
+                        read = 0.
+                        for x in topics:
+                            with frame.phase("decode"):
+                                image = bridge.imgmsg_to_cv2(pending[x].popleft()[1])
+                            with frame.phase("write"):
+                                outputs[x].append(image)
+                        tracer.write(frame.finish())
+                    else:
+                        # a frame older than the newest head can never be matched anymore
+                        for x in topics:
+                            if pending[x][0][0] < latest:
+                                pending[x].popleft()
+                last = trace.clock()
+
+            print("found {} matching paris of {} total frames".format(color.count, total))
 
     def extract(self):
-        self.extract_extrinsics()
-        self.extract_camera_info()
-        self.extract_sync_images()
+        with trace.profile(self.outpath("extract", ext="prof")):
+            self.extract_extrinsics()
+            self.extract_camera_info()
+            self.extract_sync_images()
 
 
 def bag_name_to_filename(x):
-    return x.replace(folder, "").replace("/", "_").replace(".bag", "")
+    return x.replace(config.bagfile_folder, "").replace("/", "_").replace(".bag", "")
 
 
 if __name__ == "__main__":
@@ -1,12 +1,13 @@
 import os
 import re
 import shutil
-from collections import defaultdict
+from collections import Counter, defaultdict
 
 import cv2
 import numpy as np
 
 import config
+from utils import cache, parallel, storage, trace
 from utils.reader import Reader
 
 
@@ -14,116 +15,203 @@ def gray(x):
     return cv2.cvtColor(x, cv2.COLOR_BGR2GRAY)
 
 
-_last_frame_gauss_cache = None
+def thumbnail(frame):
+    return cv2.resize(gray(frame), (320, 240))
 
 
-def get_change(last_frame, new_frame):
-    global _last_frame_gauss_cache
-    if _last_frame_gauss_cache is None or _last_frame_gauss_cache[0] is not last_frame:
-        _last_frame_gauss_cache = [last_frame, cv2.blur(cv2.resize(last_frame, (320, 240)), (3, 3))]
-    new_frame_gauss = cv2.blur(cv2.resize(new_frame, (320, 240)), (3, 3))
-    return np.sum(cv2.absdiff(new_frame_gauss, _last_frame_gauss_cache[1])) / (320 * 240)
-
-
-def get_sharpness(new_frame):
-    new_frame = cv2.resize(new_frame, (320, 240))
-    laplacian = cv2.Laplacian(new_frame, cv2.CV_64F)
+def get_sharpness(thumb):
+    laplacian = cv2.Laplacian(thumb, cv2.CV_64F)
     mean, std_dev = cv2.meanStdDev(laplacian)
     return std_dev[0][0] * std_dev[0][0]
 
 
-def get_sharpest_frame(frames, idx, batch_size):
-    indices, sharpness = [], []
-    for x in range(batch_size):
-        indices.append(idx)
-        sharpness.append(get_sharpness(gray(frames[idx])))
-        idx += 1
-        if idx >= frames.shape[0]:
-            break
-    return idx, indices[np.argmax(sharpness)]
+def score_frames(task):
+    folder, start, stop = task
+    blurred = np.ndarray(shape=(stop - start, 240, 320), dtype=np.uint8)
+    sharpness = np.ndarray(shape=(stop - start,), dtype=np.float64)
+
+    # one trace for the batch of frames
+    t = trace.Trace("score", start)
+    t.count("frames", stop - start)
+    with Reader(folder, color=True, infra=False, mmap_mode="r") as reader:
+        for i in range(start, stop):
+            with t.phase("read"):
+                frame = next(reader.frames(i, i + 1))
+            with t.phase("score"):
+                thumb = thumbnail(frame.color)
+                blurred[frame.i - start] = cv2.blur(thumb, (3, 3))
+                sharpness[frame.i - start] = get_sharpness(thumb)
+    return folder, blurred, sharpness, t.finish()
+
+
+def score_tasks(folder, count):
+    batch_size = config.score_batch_size
+    return [(folder, x, min(x + batch_size, count)) for x in range(0, count, batch_size)]
+
+
+def get_change(blurred, last_idx, start, stop):
+    diff = np.abs(blurred[start:stop].astype(np.int16) - blurred[last_idx])
+    return np.sum(diff, axis=(1, 2)) / (blurred.shape[1] * blurred.shape[2])
+
+
+def select_frames(blurred, sharpness, change_threshold, batch_size):
+    good_idx = [0]
+    last_idx = 0
+    idx = 1
+    while idx < len(sharpness):
+        # the change to the last selected frame is calculated for a window of frames at once
+        changes = get_change(blurred, last_idx, idx, min(idx + config.change_window, len(sharpness)))
+        changed = np.flatnonzero(changes > change_threshold)
+        if not len(changed):
+            idx += len(changes)
+            continue
+
+        last_idx = idx = idx + int(changed[0])
+        stop = min(idx + batch_size, len(sharpness))
+        good_idx.append(idx + int(np.argmax(sharpness[idx:stop])))
+        idx = stop
+    return good_idx
+
+
+def merge_scores(results):
+    blurred = np.concatenate([x[1] for x in results], axis=0)
+    sharpness = np.concatenate([x[2] for x in results], axis=0)
+    return blurred, sharpness
+
 
+def reduce_folder(folder, results=None, jobs=None):
+    with trace.TraceWriter(folder, "reduce") as tracer, trace.profile(os.path.join(folder, "reduce.prof")):
+        reduce_frames(folder, results, jobs, tracer)
 
-def reduce_folder(folder):
-    reader = Reader(folder, color=True, infra=True)
 
+def reduce_frames(folder, results, jobs, tracer):
     # -------------------------
     # parameters
     change_threshold = config.change_threshold
     batch_size = config.sharpest_frame_batch_size
     # -------------------------
 
-    good_idx = [0]
-    last_frame = gray(reader.color[0, ...])
-    idx = 1
-    while idx < reader.color.shape[0]:
-        frame = gray(reader.color[idx, ...])
-        change = get_change(last_frame, frame)
-        if change > change_threshold:
-            last_frame = frame
-            idx, sharp_idx = get_sharpest_frame(reader.color, idx, batch_size)
-            good_idx.append(sharp_idx)
-        else:
-            idx += 1
+    if results is None:
+        # the workers read the frames themselves, no file of this process is open while they are forked
+        with Reader(folder, color=True, infra=False, mmap_mode="r") as reader:
+            count = reader.count()
+        results = list(parallel.imap(score_frames, score_tasks(folder, count), jobs or config.jobs))
+    for x in results:
+        tracer.write(x[3])
+
+    with Reader(folder, color=True, infra=True, mmap_mode="r") as reader:
+        t = trace.Trace("reduce")
+        with t.phase("select"):
+            good_idx = select_frames(*merge_scores(results), change_threshold, batch_size)
 
-    # DEBUG: view all selected image
-    if config.debug_step2:
-        for idx in good_idx:
-            cv2.imshow("selected", cv2.cvtColor(reader.color[idx, ...], cv2.COLOR_BGR2RGB))
-            cv2.waitKey(0)
+        # DEBUG: view all selected image
+        if config.debug_step2:
+            for idx in good_idx:
+                cv2.imshow("selected", cv2.cvtColor(reader.color[idx, ...], cv2.COLOR_BGR2RGB))
+                cv2.waitKey(0)
 
-    good_color = reader.color[good_idx, ...]
-    good_infra1 = reader.infra1[good_idx, ...]
-    good_infra2 = reader.infra2[good_idx, ...]
+        with t.phase("read"):
+            good_color = reader.color[good_idx, ...]
+            good_infra1 = reader.infra1[good_idx, ...]
+            good_infra2 = reader.infra2[good_idx, ...]
 
-    print("reduced {} from {} frames to {}".format(folder, reader.color.shape[0], len(good_idx)))
+        print("reduced {} from {} frames to {}".format(folder, reader.color.shape[0], len(good_idx)))
 
-    good_infra1.dump(reader.path("infra1_reduced", ext="npy"))
-    good_infra2.dump(reader.path("infra2_reduced", ext="npy"))
-    good_color.dump(reader.path("color_reduced", ext="npy"))
+        with t.phase("write"):
+            storage.save(folder, "infra1_reduced", good_infra1)
+            storage.save(folder, "infra2_reduced", good_infra2)
+            storage.save(folder, "color_reduced", good_color)
+        t.count("frames", reader.color.shape[0])
+        t.count("selected", len(good_idx))
+        tracer.write(t.finish())
+
+
+def recording_name(chunk):
+    return chunk.split("_")[0]
 
 
 def combine_recordings(reduced, delete_old=True):
     collections = defaultdict(list)
     for name in reduced:
-        collections[name.split("_")[0]].append(name)
+        collections[recording_name(name)].append(name)
 
     for name, children in collections.items():
         print("reducing", name)
-
-        all_color = np.ndarray(shape=(0, config.color_height, config.color_width, 3), dtype=np.uint8)
-        all_infra1 = np.ndarray(shape=(0, config.ir_height, config.ir_width), dtype=np.uint8)
-        all_infra2 = np.copy(all_infra1)
-
-        for child in children:
-            reader = Reader(child, suffix="_reduced")
-            all_color = np.concatenate([all_color, reader.color], axis=0)
-            all_infra1 = np.concatenate([all_infra1, reader.infra1], axis=0)
-            all_infra2 = np.concatenate([all_infra2, reader.infra2], axis=0)
-
         os.makedirs(name, exist_ok=True)
-        reader = Reader(name, infra=False, color=False)
-        all_infra1.dump(reader.path("infra1", ext="npy"))
-        all_infra2.dump(reader.path("infra2", ext="npy"))
-        all_color.dump(reader.path("color", ext="npy"))
+
+        if config.combine_virtual:
+            storage.save_virtual(name, {x: [(child, x + "_reduced") for child in children]
+                                        for x in ["color", "infra1", "infra2"]})
+        else:
+            # the output is sized from the chunks first, every chunk is then copied into its slice
+            readers = [Reader(child, suffix="_reduced", mmap_mode="r") for child in children]
+            count = sum(reader.count() for reader in readers)
+            for x in ["color", "infra1", "infra2"]:
+                first = getattr(readers[0], x)
+                with storage.create(name, x, (count,) + first.shape[1:], first.dtype) as combined:
+                    offset = 0
+                    for reader in readers:
+                        chunk = getattr(reader, x)
+                        combined[offset:offset + chunk.shape[0], ...] = chunk
+                        offset += chunk.shape[0]
+            for reader in readers:
+                reader.close()
+            del readers
 
         if delete_old:
             for child in children:
                 print("deleting", child)
-                shutil.rmtree(child)
-
-
-def reduce_data():
+                # the trace of the chunk is kept with the recording
+                if os.path.exists(os.path.join(child, "trace.jsonl")):
+                    with open(os.path.join(child, "trace.jsonl")) as src, \
+                            open(os.path.join(name, "trace.jsonl"), "a") as dst:
+                        shutil.copyfileobj(src, dst)
+                if config.combine_virtual:
+                    # the reduced chunks are still referenced by the virtual dataset
+                    for x in ["color", "infra1", "infra2"]:
+                        storage.delete(child, x)
+                else:
+                    shutil.rmtree(child)
+
+        cache.record("reduce", name)
+
+
+def find_chunks():
     regex = re.compile("([\w\d]+)_.*_[\d]+")
 
-    reduced = []
+    chunks = []
     folders = os.listdir(config.data_directory)
     for folder in folders:
         if regex.match(folder):
             abs_folder = os.path.join(config.data_directory, folder)
-            reduce_folder(abs_folder)
-            reduced.append(abs_folder)
-
-    combine_recordings(reduced)
+            if not storage.exists(abs_folder, "color"):
+                continue
+            chunks.append(abs_folder)
+    return chunks
+
+
+def reduce_chunks(chunks, jobs=None):
+    tasks = []
+    for folder in chunks:
+        with Reader(folder, color=True, infra=False, mmap_mode="r") as reader:
+            tasks += score_tasks(folder, reader.count())
+
+    # the frames of all chunks are scored in one worker pool, a chunk is reduced as soon as its last
+    # batch of scores arrives
+    results = defaultdict(list)
+    remaining = Counter(x[0] for x in tasks)
+    for result in parallel.imap(score_frames, tasks, jobs or config.jobs):
+        folder = result[0]
+        results[folder].append(result)
+        remaining[folder] -= 1
+        if not remaining[folder]:
+            reduce_folder(folder, results=results.pop(folder))
+
+    combine_recordings(chunks)
+
+
+def reduce_data(jobs=None):
+    reduce_chunks(find_chunks(), jobs)
 
 
 if __name__ == "__main__":
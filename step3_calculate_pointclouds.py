@@ -1,66 +1,109 @@
-import gc
-import glob
+import argparse
 import os
-from time import sleep
+from types import SimpleNamespace
 
 import cv2
 import numpy as np
 
 import config
-from utils.reader import Reader
-
+from utils import cache, parallel, storage, trace
+from utils.reader import Reader, reproject
+
+worker = None
+
+
+def init_worker(name):
+    # every worker builds its matcher and projection matrix once and reads its frames itself
+    global worker
+    reader = Reader(name, color=False, infra=True, mmap_mode="r")
+    worker = SimpleNamespace(reader=reader, stereo=config.get_stereo(), Q=reader.q_matrix())
+
+
+def compute_pointclouds(task):
+    start, stop = task
+    shape = worker.reader.infra1.shape
+    if config.pointcloud_storage == "disparity":
+        output = np.ndarray(shape=(stop - start, shape[1], shape[2]), dtype=np.int16)
+    else:
+        output = np.ndarray(shape=(stop - start, shape[1] * shape[2], 3), dtype=np.float32)
+
+    records = []
+    for i in range(start, stop):
+        t = trace.Trace("pointclouds", i)
+        with t.phase("read"):
+            frame = next(worker.reader.frames(i, i + 1))
+        with t.phase("stereo"):
+            disp = worker.stereo.compute(frame.infra1, frame.infra2)
+        t.count("valid_disparities", np.count_nonzero(disp > 0))
+
+        if config.pointcloud_storage == "disparity" and not config.debug_step3:
+            output[frame.i - start, ...] = disp
+            records.append(t.finish())
+            continue
 
-def calculate_pointclouds(name):
-    print("calculating pointclouds for {}".format(name))
-    reader = Reader(name, color=False, infra=True)
-
-    shape = reader.infra1.shape
-    all_coords = np.ndarray(shape=(shape[0], shape[1] * shape[2], 3), dtype=np.float32)
-    for i in range(reader.infra1.shape[0]):
-        ir1 = reader.infra1[i, ...]
-        ir2 = reader.infra2[i, ...]
-
-        stereo = config.get_stereo()
-        disp = stereo.compute(ir1, ir2).astype(np.float32) * (1 / 16.0)
-
-        K = reader.camera_infra1["K"]
-        cx, cy, f = K[0, 2], K[1, 2], K[0, 0]
-        Tx = -reader.depth_to_infra2["translation"][0]
-        Q = np.array((
-            (1, 0, 0, -cx),
-            (0, 1, 0, -cy),
-            (0, 0, 0, f),
-            (0, 0, 1 / Tx, 0)
-        ))
-        coords = cv2.reprojectImageTo3D(disp, Q, ddepth=cv2.CV_32FC3).reshape(-1, 3)
-        coords[np.any(coords == np.inf, axis=1), :] = np.nan
-        coords[coords[:, 2] < 0, :] = np.nan
-        coords[coords[:, 2] > 10, :] = np.nan
+        with t.phase("reprojection"):
+            coords, valid = reproject(disp, worker.Q)
+            coords[np.logical_not(valid), :] = np.nan
+        t.count("valid_points", np.count_nonzero(valid))
 
         # DEBUG: show pointcloud
         if config.debug_step3:
             from utils.pcl import draw_pointcloud
             draw_pointcloud(coords)
 
-        all_coords[i, ...] = coords
+        if config.pointcloud_storage == "disparity":
+            output[frame.i - start, ...] = disp
+        else:
+            output[frame.i - start, ...] = coords
+        records.append(t.finish())
+    return start, output, records
 
-    path = reader.path("coords", ext="npy")
-    del reader
-    gc.collect()
-    sleep(1)
 
-    np.save(path, all_coords, allow_pickle=False)
-
-
-def calculate_all_pointclouds():
-    folders = glob.glob(os.path.join(config.data_directory, "**/color.npy"))
-    for folder in folders:
-        dir = os.path.dirname(folder)
-        if os.path.exists(dir + "/coords.npy"):
+def calculate_pointclouds(name, jobs=None):
+    print("calculating pointclouds for {}".format(name))
+    # DEBUG: the pointcloud viewer only works in this process
+    jobs = 1 if config.debug_step3 else jobs or config.jobs
+
+    # the workers open the arrays themselves, they are closed here before the pool is started
+    with Reader(name, color=False, infra=True, mmap_mode="r") as reader:
+        shape = reader.infra1.shape
+        count = reader.count()
+        Q = reader.q_matrix()
+    tasks = [(x, min(x + config.stereo_batch_size, count)) for x in range(0, count, config.stereo_batch_size)]
+    if config.pointcloud_storage == "disparity":
+        # fixed point disparities as computed by SGBM, reprojected on demand by the Reader
+        storage.save(name, "q_matrix", Q)
+        output = storage.create(name, "disparity", (count, shape[1], shape[2]), np.int16)
+    else:
+        output = storage.create(name, "coords", (count, shape[1] * shape[2], 3), np.float32)
+
+    with output as all_output, trace.TraceWriter(name, "pointclouds") as tracer, \
+            trace.profile(os.path.join(name, "pointclouds.prof")):
+        for start, result, records in parallel.imap(compute_pointclouds, tasks, jobs, init_worker, (name,)):
+            write_start = trace.clock()
+            all_output[start:start + result.shape[0], ...] = result
+            seconds = trace.clock() - write_start
+
+            # the block is written at once, every frame is charged its share
+            for record in records:
+                record["phases"]["write"] = seconds / len(records)
+                tracer.write(record)
+
+    # the Reader prefers dense pointclouds, a previous run with the other storage mode must not shadow this one
+    storage.delete(name, "coords" if config.pointcloud_storage == "disparity" else "disparity")
+    cache.record("pointclouds", name)
+
+
+def calculate_all_pointclouds(jobs=None):
+    for dir in storage.find(config.data_directory, "color"):
+        if cache.is_fresh("pointclouds", dir):
             continue
 
-        calculate_pointclouds(dir)
+        calculate_pointclouds(dir, jobs)
 
 
 if __name__ == "__main__":
-    calculate_all_pointclouds()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=config.jobs, help="number of stereo worker processes")
+    args = parser.parse_args()
+    calculate_all_pointclouds(args.jobs)
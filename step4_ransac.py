@@ -1,86 +1,104 @@
 import gc
-import glob
 import os
-import random
 import sys
 
 import numpy as np
 
-import pcl
-
 import config
-from utils.reader import Reader
-
-
-def augment(xyzs):
-    axyz = np.ones((len(xyzs), 4))
-    axyz[:, :3] = xyzs
-    return axyz
+from utils import cache, storage, trace
+from utils.plane import inliers, orient, refine, voxel_downsample
+from utils.reader import Reader, find_pointclouds
 
 
-def estimate(xyzs):
-    return np.linalg.svd(xyzs)[-1][-1, :]
+def track_plane(coords, plane, min_inliers):
+    # refits the plane of the previous frame, None if it does not explain the pointcloud anymore
+    indices = inliers(coords, plane, config.ransac_distance_threshold)
+    if len(indices) < max(min_inliers, 3):
+        return None, None
 
+    model = orient(refine(coords[indices]), plane)
+    return inliers(coords, model, config.ransac_distance_threshold), model.tolist()
 
-def run_ransac(data, sample_size, goal_inliers, max_iterations,
-               stop_at_goal=True, random_seed=None, thresh=0.05):
-    data = augment(data)
 
-    best_ic = 0
-    best_model = None
-    if random_seed:
-        random.seed(random_seed)
+def segment_plane(coords):
+    if not config.voxel_leaf_size:
+        return config.make_segmenter(coords).segment()
 
-    idx = list(range(data.shape[0]))
-    for i in range(max_iterations):
-        s = data[random.sample(idx, sample_size)]
-        m = estimate(s)
-        ic = np.count_nonzero(np.abs(m.dot(data.T)) < thresh)
-        if ic > best_ic:
-            best_ic = ic
-            best_model = m
-            if stop_at_goal and ic > goal_inliers:
-                break
-
-    return best_model, best_ic
+    # the plane is found on the downsampled pointcloud, the inliers are taken from the full pointcloud
+    model = config.make_segmenter(voxel_downsample(coords, config.voxel_leaf_size)).segment()[1]
+    return inliers(coords, np.asarray(model), config.ransac_distance_threshold), model
 
 
 def calculate_ransac(name):
     print("calculating ransac planes for", name)
-    reader = Reader(name, color=False, infra=False, coords=True)
-
-    good_idx = np.zeros(shape=(reader.coords.shape[0], reader.coords.shape[1]), dtype=np.bool)
-    planes = np.ndarray(shape=(reader.coords.shape[0], 4), dtype=np.float32)
-
-    for i in range(reader.coords.shape[0]):
-        coords = reader.coords_not_nan(i)
-        p = pcl.PointCloud(coords)
-        seg = config.make_segmenter(p)
-        indices, model = seg.segment()
-
-        del p
-        gc.collect()
-        sys.stdout.write(".")
-        sys.stdout.flush()
-
-        good_idx[i, indices] = True
-        planes[i, :] = model
-
-        # DEBUG: show segmented cloud
-        if config.debug_step4:
-            from utils.pcl import draw_pointcloud, color_inlier
-            draw_pointcloud(coords, colors=color_inlier(coords, indices), plane=model)
-
-    print(" done.")
-    np.save(reader.path("good_idx", ext="npy"), good_idx, allow_pickle=False)
-    np.save(reader.path("planes", ext="npy"), planes, allow_pickle=False)
+    reader = Reader(name, color=False, infra=False, coords=True, mmap_mode="r")
+
+    if config.pack_inliers:
+        good_idx = np.zeros(shape=(reader.count(), (reader.pixel_count() + 7) // 8), dtype=np.uint8)
+    else:
+        good_idx = np.zeros(shape=(reader.count(), reader.pixel_count()), dtype=np.bool)
+    planes = np.ndarray(shape=(reader.count(), 4), dtype=np.float32)
+
+    tracked = 0
+    reference_ratio = None
+    with trace.TraceWriter(name, "ransac") as tracer, trace.profile(os.path.join(name, "ransac.prof")):
+        start = trace.clock()
+        for i, frame in enumerate(reader.frames()):
+            # the pointcloud is reprojected by the generator, before the trace of the frame is created
+            t = trace.Trace("ransac", i, start)
+            t.add("reprojection", trace.clock() - start)
+            coords = frame.coords
+            indices = None
+            if config.ransac_tracking and reference_ratio is not None:
+                min_inliers = config.tracking_min_inlier_ratio * reference_ratio * len(coords)
+                with t.phase("tracking"):
+                    indices, model = track_plane(coords, planes[frame.i - 1, :], min_inliers)
+
+            if indices is None:
+                with t.phase("segmentation"):
+                    indices, model = segment_plane(coords)
+                # a frame without a plane is no reference for tracking the next one
+                reference_ratio = len(indices) / max(len(coords), 1) if np.any(model[:3]) else None
+
+                gc.collect()
+                t.count("tracked", 0)
+                sys.stdout.write(".")
+            else:
+                tracked += 1
+                t.count("tracked", 1)
+                sys.stdout.write(",")
+            sys.stdout.flush()
+
+            with t.phase("write"):
+                if config.pack_inliers:
+                    inlier = np.zeros(shape=(reader.pixel_count(),), dtype=np.bool)
+                    inlier[indices] = True
+                    good_idx[frame.i, :] = np.packbits(inlier)
+                else:
+                    good_idx[frame.i, indices] = True
+                planes[frame.i, :] = model
+
+            t.count("points", len(coords))
+            t.count("inliers", len(indices))
+            tracer.write(t.finish())
+
+            # DEBUG: show segmented cloud
+            if config.debug_step4:
+                from utils.pcl import draw_pointcloud, color_inlier
+                draw_pointcloud(coords, colors=color_inlier(coords, indices), plane=model)
+            start = trace.clock()
+
+    print(" done, {} of {} frames tracked.".format(tracked, reader.count()))
+    reader.close()
+    storage.save(name, "good_idx_packed" if config.pack_inliers else "good_idx", good_idx)
+    storage.delete(name, "good_idx" if config.pack_inliers else "good_idx_packed")
+    storage.save(name, "planes", planes)
+    cache.record("ransac", name)
 
 
 def calculate_all_ransac():
-    folders = glob.glob(os.path.join(config.data_directory, "**/coords.npy"))
-    for folder in folders:
-        dir = os.path.dirname(folder)
-        if os.path.exists(dir + "/planes.npy"):
+    for dir in find_pointclouds(config.data_directory):
+        if cache.is_fresh("ransac", dir):
             continue
 
         calculate_ransac(dir)
@@ -1,21 +1,25 @@
-import glob
+import argparse
 import os
 
 import cv2
 import numpy as np
-import png
 import pydensecrf.densecrf as dcrf
 from pydensecrf.utils import unary_from_labels
 
 import config
+from step6_connected_components import clean_mask
+from utils import cache, parallel, storage, trace
 from utils.reader import Reader, Labels
+from utils.writer import AsyncWriter, write_color, write_png
 
 
-def points_to_image(coords, reader, value=None):
-    if not len(coords):
-        tempimg = np.zeros(shape=(config.color_height, config.color_width), dtype=np.float32)
-        return tempimg[..., np.newaxis]
+# point classes in order of priority, when points of different classes fall onto the same pixel the
+# higher class wins. mask_values maps them to the values of the mask before the crf
+point_none, point_obstacle, point_ground, point_ignore = range(4)
+mask_values = np.array([0, 2, 1, 0], dtype=np.int32)
 
+
+def project_points(coords, reader):
     imgpts, jac = cv2.projectPoints(coords,
                                     rvec=reader.depth_to_color["rotation"].reshape(3, 3).transpose(),
                                     tvec=reader.depth_to_color["translation"],
@@ -26,12 +30,20 @@ def points_to_image(coords, reader, value=None):
     imgpts[imgpts[:, 1] >= config.color_height] = 0
     imgpts[imgpts[:, 0] >= config.color_width] = 0
     imgpts[imgpts < 0] = 0
+    return imgpts
+
 
-    tempimg = np.zeros(shape=(config.color_height, config.color_width), dtype=np.float32)
-    tempimg[imgpts[:, 1], imgpts[:, 0]] = value if value is not None else 1
-    kernel = np.ones((3, 3), np.float32)
-    tempimg = cv2.morphologyEx(tempimg, cv2.MORPH_DILATE, kernel)
-    return tempimg[..., np.newaxis]
+def rasterize(coords, classes, reader):
+    # projects all points once and draws their classes into one image, the dilation then spreads
+    # the highest class of each 3x3 neighbourhood
+    tempimg = np.zeros(shape=(config.color_height, config.color_width), dtype=np.uint8)
+    if len(coords):
+        imgpts = project_points(coords, reader)
+        for x in [point_obstacle, point_ground, point_ignore]:
+            pts = imgpts[classes == x]
+            tempimg[pts[:, 1], pts[:, 0]] = x
+    kernel = np.ones((3, 3), np.uint8)
+    return cv2.dilate(tempimg, kernel)
 
 
 def augment(xyzs):
@@ -44,133 +56,239 @@ def dist_from_plane(coeffs, xyz):
     return coeffs.dot(xyz.T)
 
 
-def write_png(mask, path):
-    fullpalette = [(0, 0, 0), ] * 255
-    fullpalette[0] = (0, 255, 0)
-    fullpalette[1] = (255, 0, 0)
-    out = png.Writer(mask.shape[1], mask.shape[0], palette=fullpalette)
-    with open(path, "wb") as f:
-        out.write(f, mask)
-
-
-def calculate_masks(name):
-    print("calculating masks", name)
-
-    os.makedirs(os.path.join(name, "label"), exist_ok=True)
-    os.makedirs(os.path.join(name, "color"), exist_ok=True)
-
+def create_mask(frame, reader):
     # -------------------
     # parameter
     below_ok = 0.01
     abote_nok = 0.05
     # ------------------
 
-    reader = Reader(name, color=True, infra=False, coords=True, planes=True)
-    for i in range(reader.coords.shape[0]):
-        color = cv2.cvtColor(reader.color[i, ...], cv2.COLOR_BGR2RGB)
-        coords = reader.coords_not_nan(i)
-        coords_4 = augment(coords)
-
-        plane = reader.model(i)
-        idx_inlier = reader.inlier(i)
-        dZ = dist_from_plane(plane, coords_4)
-        if reader.is_inverse:
-            dZ *= -1
-
-        mask_inlier = np.zeros(len(coords), dtype=bool)
-        mask_obstacle = np.zeros(len(coords), dtype=bool)
-        mask_ignore = np.zeros(len(coords), dtype=bool)
-
-        # inliers from ransac
-        mask_inlier[idx_inlier] = True
-
-        # everything too far above ground is not an inlier, even if ransac saied so
-        mask_inlier[dZ > abote_nok] = False
-
-        # everything a little below ground is an inlier, even if ransac didnt agree
-        if reader.below_is_obstacle:
-            mask_inlier[np.logical_and(dZ <= 0, dZ > -below_ok)] = True
-        else:
-            mask_inlier[dZ <= 0] = True
-
-            # everything 0.7 meter below the ground will be ignored (mostly errors)
-            mask_ignore[dZ < -0.7] = True
-
-        # everything 10 meters away will be ignored
-        mask_ignore[coords[:, 2] > 5] = True
-
-        # everything above and below the ground is an obstacle
-        mask_obstacle[dZ > 0] = True
-        if reader.below_is_obstacle:
-            mask_obstacle[dZ < -below_ok] = True
-
-        mask_inlier = points_to_image(coords[mask_inlier, :], reader)
-        mask_obstacle = points_to_image(coords[mask_obstacle, :], reader)
-        mask_ignore = points_to_image(coords[mask_ignore, :], reader)
-
-        mask_final = np.zeros(shape=(config.color_height, config.color_width, 1), dtype=np.int32)
-        mask_final[mask_obstacle == 1] = 2
-        mask_final[mask_inlier == 1] = 1
-        mask_final[mask_ignore == 1] = 0
-
-        # recalculate the ignore mask to be all not colored pixels
-        mask_ignore = mask_final == 0
-
-        # border always has some artifacts
-        mask_final[:2, :] = 0
-        mask_final[-2:, :] = 0
-        mask_final[:, :2] = 0
-        mask_final[:, -2:] = 0
-
-        # DEBUG: show mask before crf
-        if config.debug_step5:
-            cv2.imshow("mask", mask_final.astype(np.uint8) * 127)
-            cv2.waitKey(0)
-
-        # DEBUG: set to false for no crf
-        if config.crf_enabled:
-            d = dcrf.DenseCRF2D(config.color_width, config.color_height, 2)
-            U = unary_from_labels(mask_final[..., 0], 2, gt_prob=config.crf_label_gt_prob, zero_unsure=True)
-            d.setUnaryEnergy(U)
-
-            config.configure_crf(d, color)
-
-            Q = d.inference(config.crf_inference_count)
-            MAP = np.argmax(Q, axis=0)
-            MAP = (MAP.reshape(color.shape[0], color.shape[1]).astype(np.uint8))[..., np.newaxis]
-        else:
-            MAP = mask_final.astype(np.uint8)
-
-        MAP[mask_ignore == 1] = 255
-
-        # DEBUG: show final mask in gray
-        if config.debug_step5:
-            cv2.imshow("mask", MAP * 127)
-            cv2.waitKey(0)
-
-        if reader.is_inverse:
-            MAP = cv2.rotate(MAP, cv2.ROTATE_180)
-            color = cv2.rotate(color, cv2.ROTATE_180)
-
-        filename = os.path.basename(name) + "_%05d.png" % i
-        write_png(MAP, os.path.join(name, "label", filename))
-        cv2.imwrite(os.path.join(name, "color", filename), color)
-
-        # DEBUG: show final color mask
-        if config.debug_step5:
-            label = Labels(name)
-            cv2.imshow("final", cv2.addWeighted(label.color(i), 0.5, label.label(i), 0.5, 0))
-            cv2.waitKey(0)
-
-
-def calculate_all_masks():
-    folders = glob.glob(os.path.join(config.data_directory, "**/planes.npy"))
-    for folder in folders:
-        dir = os.path.dirname(folder)
-        if os.path.exists(dir + "/label") and "demo" not in dir:
+    coords = frame.coords
+    coords_4 = augment(coords)
+
+    plane = frame.plane
+    idx_inlier = frame.inlier
+    dZ = dist_from_plane(plane, coords_4)
+    if reader.is_inverse:
+        dZ *= -1
+
+    mask_inlier = np.zeros(len(coords), dtype=bool)
+    mask_obstacle = np.zeros(len(coords), dtype=bool)
+    mask_ignore = np.zeros(len(coords), dtype=bool)
+
+    # inliers from ransac
+    mask_inlier[idx_inlier] = True
+
+    # everything too far above ground is not an inlier, even if ransac saied so
+    mask_inlier[dZ > abote_nok] = False
+
+    # everything a little below ground is an inlier, even if ransac didnt agree
+    if reader.below_is_obstacle:
+        mask_inlier[np.logical_and(dZ <= 0, dZ > -below_ok)] = True
+    else:
+        mask_inlier[dZ <= 0] = True
+
+        # everything 0.7 meter below the ground will be ignored (mostly errors)
+        mask_ignore[dZ < -0.7] = True
+
+    # everything 10 meters away will be ignored
+    mask_ignore[coords[:, 2] > 5] = True
+
+    # everything above and below the ground is an obstacle
+    mask_obstacle[dZ > 0] = True
+    if reader.below_is_obstacle:
+        mask_obstacle[dZ < -below_ok] = True
+
+    classes = np.full(len(coords), point_none, dtype=np.uint8)
+    classes[mask_obstacle] = point_obstacle
+    classes[mask_inlier] = point_ground
+    classes[mask_ignore] = point_ignore
+
+    return mask_values[rasterize(coords, classes, reader)][..., np.newaxis]
+
+
+def crf_inference(mask, color, scale=1.):
+    height, width = mask.shape
+    d = dcrf.DenseCRF2D(width, height, 2)
+    U = unary_from_labels(mask, 2, gt_prob=config.crf_label_gt_prob, zero_unsure=True)
+    d.setUnaryEnergy(U)
+
+    config.configure_crf(d, np.ascontiguousarray(color), scale)
+
+    Q = d.inference(config.crf_inference_count)
+    return np.array(Q, dtype=np.float32).reshape(2, height, width)
+
+
+def crf_downscaled(mask, color):
+    # inference on a smaller image, the probabilities are scaled back up
+    scale = config.crf_downscale
+    size = (int(mask.shape[1] * scale), int(mask.shape[0] * scale))
+    Q = crf_inference(cv2.resize(mask, size, interpolation=cv2.INTER_NEAREST),
+                      cv2.resize(color, size, interpolation=cv2.INTER_AREA), scale)
+    Q = np.stack([cv2.resize(x, (mask.shape[1], mask.shape[0]), interpolation=cv2.INTER_LINEAR) for x in Q])
+    return np.argmax(Q, axis=0).astype(np.uint8)
+
+
+def crf_band(mask, color):
+    # inference only on the tiles which contain pixels close to a label transition, including the
+    # borders of the unlabeled areas. everywhere else the labels are copied
+    MAP = np.maximum(mask - 1, 0).astype(np.uint8)
+    kernel = np.ones((3, 3), np.uint8)
+    band = cv2.dilate(mask.astype(np.uint8), kernel) != cv2.erode(mask.astype(np.uint8), kernel)
+    band = cv2.dilate(band.astype(np.uint8), np.ones((2 * config.crf_band_width + 1,) * 2, np.uint8))
+
+    tile, margin = config.crf_tile_size, config.crf_band_width
+    height, width = mask.shape
+    for y in range(0, height, tile):
+        for x in range(0, width, tile):
+            if not band[y:y + tile, x:x + tile].any():
+                continue
+
+            # the tile is extended by a margin, so the pairwise terms see the surrounding pixels
+            y0, x0 = max(y - margin, 0), max(x - margin, 0)
+            y1, x1 = min(y + tile + margin, height), min(x + tile + margin, width)
+            Q = crf_inference(mask[y0:y1, x0:x1], color[y0:y1, x0:x1])
+            MAP[y:y + tile, x:x + tile] = np.argmax(Q, axis=0)[y - y0:y - y0 + tile, x - x0:x - x0 + tile]
+    return MAP
+
+
+def refine_mask(mask_final, color):
+    # DEBUG: set to false for no crf
+    if not config.crf_enabled:
+        return mask_final.astype(np.uint8), None
+
+    mask = np.ascontiguousarray(mask_final[..., 0])
+    if config.crf_mode == "downscale":
+        MAP = crf_downscaled(mask, color)
+    elif config.crf_mode == "band":
+        MAP = crf_band(mask, color)
+    else:
+        MAP = np.argmax(crf_inference(mask, color), axis=0).astype(np.uint8)
+
+    agreement = None
+    if config.crf_report_agreement and config.crf_mode != "full":
+        full = np.argmax(crf_inference(mask, color), axis=0)
+        agreement = np.count_nonzero((MAP == full)[mask != 0]) / max(np.count_nonzero(mask), 1)
+    return MAP[..., np.newaxis], agreement
+
+
+worker = None
+
+
+def init_worker(name):
+    global worker
+    worker = Reader(name, color=True, infra=False, coords=True, planes=True, mmap_mode="r")
+
+
+def compute_mask(i):
+    t = trace.Trace("masks", i)
+    with t.phase("read"):
+        frame = next(worker.frames(i, i + 1))
+    color = cv2.cvtColor(frame.color, cv2.COLOR_BGR2RGB)
+    with t.phase("projection"):
+        mask_final = create_mask(frame, worker)
+    t.count("points", len(frame.coords))
+    t.count("inliers", len(frame.inlier[0]))
+
+    # recalculate the ignore mask to be all not colored pixels
+    mask_ignore = mask_final == 0
+
+    # border always has some artifacts, the pixels not colored before are ignored after the crf
+    mask_final[:2, :] = 0
+    mask_final[-2:, :] = 0
+    mask_final[:, :2] = 0
+    mask_final[:, -2:] = 0
+
+    # DEBUG: show mask before crf
+    if config.debug_step5:
+        cv2.imshow("mask", mask_final.astype(np.uint8) * 127)
+        cv2.waitKey(0)
+
+    with t.phase("crf"):
+        MAP, agreement = refine_mask(mask_final, color)
+    MAP[mask_ignore == 1] = 255
+
+    # DEBUG: show final mask in gray
+    if config.debug_step5:
+        cv2.imshow("mask", MAP * 127)
+        cv2.waitKey(0)
+
+    if worker.is_inverse:
+        MAP = cv2.rotate(MAP, cv2.ROTATE_180)
+        color = cv2.rotate(color, cv2.ROTATE_180)
+
+    # the connected components of step 6 are cleaned on the mask in memory
+    clean = None
+    if config.fuse_clean:
+        with t.phase("connected_components"):
+            clean = clean_mask(MAP.reshape(MAP.shape[:2]), t)
+    return i, MAP, clean, color, agreement, t.finish()
+
+
+def calculate_masks(name, jobs=None):
+    print("calculating masks", name)
+
+    os.makedirs(os.path.join(name, "label"), exist_ok=True)
+    os.makedirs(os.path.join(name, "color"), exist_ok=True)
+    if config.fuse_clean:
+        os.makedirs(os.path.join(name, "label_clean"), exist_ok=True)
+
+    # DEBUG: the debug windows only work in this process
+    jobs = 1 if config.debug_step5 else jobs or config.jobs
+
+    # frames are independent of each other, the masks are calculated in the worker pool and written
+    # here in order
+    with Reader(name, color=True, infra=False, mmap_mode="r") as reader:
+        count = reader.count()
+    labels = Labels(name)
+    labels.reset_manifest()
+    agreements = []
+    with AsyncWriter(config.writer_queue_size) as writer, trace.TraceWriter(name, "masks") as tracer, \
+            trace.profile(os.path.join(name, "masks.prof")):
+        tasks = parallel.imap(compute_mask, range(count), jobs, init_worker, (name,))
+        for i, MAP, clean, color, agreement, record in tasks:
+            if agreement is not None:
+                agreements.append(agreement)
+
+            # the images are written in the background, only the time waiting for the writer is counted
+            write_start = trace.clock()
+            filename = os.path.basename(name) + "_%05d.png" % i
+            if clean is None or config.fused_write_label:
+                writer.submit(write_png, MAP, os.path.join(name, "label", filename), config.png_compression)
+            if clean is not None:
+                writer.submit(write_png, clean, os.path.join(name, "label_clean", filename), config.png_compression)
+            writer.submit(write_color, color, os.path.join(name, "color", filename), config.png_compression)
+            # listed in the manifest once its images are written
+            writer.submit(labels.add_frame, filename, i, MAP.shape[:2], clean is not None)
+            record["phases"]["write_wait"] = trace.clock() - write_start
+            tracer.write(record)
+
+            # DEBUG: show final color mask
+            if config.debug_step5:
+                writer.flush()
+                label = Labels(name)
+                mask = label.label(i, cleaned=clean is not None)
+                cv2.imshow("final", cv2.addWeighted(label.color(i), 0.5, mask, 0.5, 0))
+                cv2.waitKey(0)
+
+    if agreements:
+        print("{} crf agrees with the full crf on {:.2%} of the labeled pixels (worst frame {:.2%})".format(
+            config.crf_mode, np.mean(agreements), np.min(agreements)))
+
+    cache.record("masks", name)
+    if config.fuse_clean:
+        cache.record("clean", name)
+
+
+def calculate_all_masks(jobs=None):
+    for dir in storage.find(config.data_directory, "planes"):
+        if cache.is_fresh("masks", dir) and "demo" not in dir:
             continue
-        calculate_masks(dir)
+        calculate_masks(dir, jobs)
 
 
 if __name__ == "__main__":
-    calculate_all_masks()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=config.jobs, help="number of mask worker processes")
+    args = parser.parse_args()
+    calculate_all_masks(args.jobs)
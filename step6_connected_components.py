@@ -1,86 +1,137 @@
+import argparse
 import glob
 import os
+from contextlib import ExitStack
 
 import cv2
 import numpy as np
 
 import config
-from step5_create_mask import write_png
+from utils import cache, parallel, trace
 from utils.reader import Labels
+from utils.writer import write_png
 
 
 def clean_obstacles(mask):
+    # components touching the left, top or right border of the image and big components are kept,
+    # returns the number of components
     n, labels, stats, _ = cv2.connectedComponentsWithStats(mask)
-    good_components = []
-    for x in range(1, n):
-        stat = stats[x]
-        is_good = \
-            stat[0] <= 0 or \
-            stat[1] <= 0 or \
-            stat[0] + stat[2] >= mask.shape[1]
-
-        is_good = is_good or stat[4] >= config.min_obstacle_pixel_count
-        if not is_good:
-            good_components.append(x)
-
-    for component in good_components:
-        mask[labels == component] = 0
+    keep = np.logical_or.reduce([
+        stats[:, cv2.CC_STAT_LEFT] <= 0,
+        stats[:, cv2.CC_STAT_TOP] <= 0,
+        stats[:, cv2.CC_STAT_LEFT] + stats[:, cv2.CC_STAT_WIDTH] >= mask.shape[1],
+        stats[:, cv2.CC_STAT_AREA] >= config.min_obstacle_pixel_count
+    ])
+    keep[0] = True
+    mask[np.logical_not(keep[labels])] = 0
+    return n - 1
 
 
 def clean_ground(mask):
+    # only the biggest component is kept, returns the number of components
     n, labels, stats, _ = cv2.connectedComponentsWithStats(mask)
-    biggest_component = None
-    biggest_pixels = None
-    for x in range(1, n):
-        pixels = stats[x][cv2.CC_STAT_AREA]
-        if biggest_pixels is None or pixels > biggest_pixels:
-            biggest_pixels = pixels
-            biggest_component = x
-
-    for x in range(1, n):
-        if x != biggest_component:
-            mask[np.where(labels == x)] = 0
-
-
-def clean_cc(name):
-    print("cleaning", name)
-    os.makedirs(os.path.join(name, "label_clean"), exist_ok=True)
+    if n <= 2:
+        return n - 1
+
+    keep = np.zeros(shape=(n,), dtype=np.bool)
+    keep[0] = True
+    keep[1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])] = True
+    mask[np.logical_not(keep[labels])] = 0
+    return n - 1
+
+
+def clean_label(label, t=None):
+    # label as read from the label png in bgr
+    return clean_classes(label[..., 1] == 255, label[..., 2] == 255, t)
+
+
+def clean_mask(mask, t=None):
+    # mask with 0 for ground, 1 for obstacles and 255 for ignored pixels, as written by step 5
+    return clean_classes(mask == 0, mask == 1, t)
+
+
+def clean_classes(ground, obstacle, t=None):
+    obstacle = obstacle.astype(np.uint8) * 255
+    ground = ground.astype(np.uint8) * 255
+
+    ground_components = clean_ground(ground)
+    obstacle_components = clean_obstacles(obstacle)
+    if t is not None:
+        t.count("ground_components", ground_components)
+        t.count("obstacle_components", obstacle_components)
+
+    mask = np.ones(shape=(ground.shape[:2]), dtype=np.uint8) * 255
+    mask[ground == 255] = 0
+    mask[obstacle == 255] = 1
+    return mask
+
+
+def clean_frame(task):
+    name, x = task
     labels = Labels(name)
-    for x in range(labels.count()):
+    t = trace.Trace("clean", x)
+    with t.phase("read"):
         label = labels.label(x)
+    with t.phase("connected_components"):
+        mask = clean_label(label, t)
+
+    filename = os.path.basename(name) + "_%05d.png" % x
+    with t.phase("write"):
+        write_png(mask, name + "/label_clean/" + filename, config.png_compression)
+
+    # DEBUG: show mask before cleaning
+    if config.debug_step6:
+        cv2.imshow("label", cv2.addWeighted(labels.label(x, cleaned=False), (1. - 0.5), labels.color(x), 0.5, 0))
+        cv2.waitKey(0)
+
+    # DEBUG: show final mask
+    if config.debug_step6:
+        cv2.imshow("label", cv2.addWeighted(labels.label(x, cleaned=True), (1. - 0.5), labels.color(x), 0.5, 0))
+        cv2.waitKey(0)
+
+    return name, filename, t.finish()
 
-        obstacle = (label[..., 2] == 255).astype(np.uint8) * 255
-        ground = (label[..., 1] == 255).astype(np.uint8) * 255
 
-        clean_ground(ground)
-        clean_obstacles(obstacle)
+def clean_tasks(tasks, labels, tracers, jobs):
+    for name, filename, record in parallel.imap(clean_frame, tasks, jobs, chunksize=16):
+        labels[name].update(filename, cleaned=True)
+        tracers[name].write(record)
 
-        mask = np.ones(shape=(label.shape[:2]), dtype=np.uint8) * 255
-        mask[ground == 255] = 0
-        mask[obstacle == 255] = 1
 
-        filename = os.path.basename(name) + "_%05d.png" % x
-        write_png(mask, name + "/label_clean/" + filename)
+def clean_cc(names, jobs=None):
+    # the frames of all datasets are cleaned together in one worker pool
+    tasks = []
+    labels = {}
+    for name in names:
+        print("cleaning", name)
+        os.makedirs(os.path.join(name, "label_clean"), exist_ok=True)
+        labels[name] = Labels(name)
+        tasks += [(name, x["index"]) for x in labels[name].frames()]
 
-        # DEBUG: show mask before cleaning
-        if config.debug_step6:
-            cv2.imshow("label", cv2.addWeighted(labels.label(x, cleaned=False), (1. - 0.5), labels.color(x), 0.5, 0))
-            cv2.waitKey(0)
+    # DEBUG: the debug windows only work in this process
+    jobs = 1 if config.debug_step6 else jobs or config.jobs
+    with ExitStack() as stack:
+        tracers = {name: stack.enter_context(trace.TraceWriter(name, "clean")) for name in names}
+        if config.trace_profile:
+            # every dataset gets its own profile, so the datasets are cleaned one after another
+            for name in names:
+                with trace.profile(os.path.join(name, "clean.prof")):
+                    clean_tasks([x for x in tasks if x[0] == name], labels, tracers, jobs)
+        else:
+            clean_tasks(tasks, labels, tracers, jobs)
 
-        # DEBUG: show final mask
-        if config.debug_step6:
-            cv2.imshow("label", cv2.addWeighted(labels.label(x, cleaned=True), (1. - 0.5), labels.color(x), 0.5, 0))
-            cv2.waitKey(0)
+    for name in names:
+        cache.record("clean", name)
 
 
-def clean_all_cc():
-    folders = glob.glob("/data/**/label")
-    for folder in folders:
-        dir = os.path.dirname(folder)
-        if os.path.exists(dir + "/label_clean"):
-            continue
-        clean_cc(dir)
+def clean_all_cc(jobs=None):
+    folders = glob.glob(os.path.join(config.data_directory, "**/label"))
+    names = [os.path.dirname(x) for x in folders if not cache.is_fresh("clean", os.path.dirname(x))]
+    clean_cc(names, jobs)
 
 
 if __name__ == "__main__":
-    clean_all_cc()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=config.jobs, help="number of cleaning worker processes")
+    args = parser.parse_args()
+    clean_all_cc(args.jobs)
@@ -6,6 +6,7 @@ from types import SimpleNamespace
 import cv2
 
 import config
+from utils.prefetch import FrameCache
 from utils.reader import Labels
 
 state = None
@@ -15,15 +16,19 @@ def reset_state(dir):
     global state
     labels = Labels(dir)
     good, bad = labels.load_good_bad_index()
+    stale = labels.stale_reviews()
     state = SimpleNamespace(
         i=None,
         history=[],
         labels=labels,
         good=good,
         bad=bad,
-        ignore=good | bad,
+        stale=stale,
+        # frames whose mask changed since they were reviewed are shown again
+        ignore=(good | bad) - stale,
         todo=None,
-        mask_mode=0
+        mask_mode=0,
+        frames=FrameCache(labels, config.review_cache_size)
     )
     state.todo = list(set(labels.names()) - state.ignore)
 
@@ -32,28 +37,32 @@ def name():
     return state.history[state.i]
 
 
+def upcoming():
+    # the frames which can be reached with the next keystrokes, nearest first
+    n = config.review_prefetch
+    ahead = state.history[state.i + 1:] + [x for x in reversed(state.todo) if x != "END"]
+    behind = state.history[max(state.i - n, 0):state.i]
+    return ahead[:n] + behind[::-1]
+
+
 def show_frame():
-    if state.mask_mode == 0:
-        img = cv2.addWeighted(state.labels.color(name=name()), 0.5,
-                              state.labels.label(name=name(), cleaned=True), 0.5, 0)
-    elif state.mask_mode == 1:
-        img = state.labels.color(name=name())
-    elif state.mask_mode == 2:
-        img = state.labels.label(name=name(), cleaned=True)
+    img = state.frames.get(name(), state.mask_mode)
 
     render = np.zeros(shape=(img.shape[0] + 20, img.shape[1], 3), dtype=np.uint8)
     render[20:, :, :] = img
 
+    old = " (old mask)" if name() in state.stale else ""
     if name() in state.good:
-        cv2.putText(render, "good", (5, 15), cv2.FONT_HERSHEY_PLAIN, 1, (0, 255, 0))
+        cv2.putText(render, "good" + old, (5, 15), cv2.FONT_HERSHEY_PLAIN, 1, (0, 255, 0))
     elif name() in state.bad:
-        cv2.putText(render, "bad", (5, 15), cv2.FONT_HERSHEY_PLAIN, 1, (0, 0, 255))
+        cv2.putText(render, "bad" + old, (5, 15), cv2.FONT_HERSHEY_PLAIN, 1, (0, 0, 255))
     else:
         cv2.putText(render, "not reviewed", (5, 15), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255))
 
     cv2.putText(render, name(), (300, 15), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255))
 
     cv2.imshow("Mask Review", render)
+    state.frames.prefetch(upcoming())
     return cv2.waitKey(0)
 
 
@@ -74,11 +83,15 @@ def backward():
 def good():
     state.good.add(name())
     state.bad.discard(name())
+    state.stale.discard(name())
+    state.labels.update(name(), review="good", stale=False)
 
 
 def bad():
     state.bad.add(name())
     state.good.discard(name())
+    state.stale.discard(name())
+    state.labels.update(name(), review="bad", stale=False)
 
 
 def end():
@@ -127,19 +140,23 @@ def take_next_frame():
 
 def review(dir):
     reset_state(dir)
-    if not state.todo:
-        return
+    try:
+        if not state.todo:
+            return
 
-    state.todo.insert(0, "END")
-    take_next_frame()
-    while state.todo:
-        if name() in state.ignore:
-            continue
+        state.todo.insert(0, "END")
+        take_next_frame()
+        while state.todo:
+            if name() in state.ignore:
+                continue
 
-        key = show_frame()
-        process_key_stroke(key)
+            key = show_frame()
+            process_key_stroke(key)
 
-    end()
+        end()
+    finally:
+        # the loader threads are stopped as well when escape exits the interface
+        state.frames.close()
 
 
 def review_all():
@@ -0,0 +1,136 @@
+import argparse
+import glob
+import io
+import json
+import os
+import tarfile
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import config
+from utils import cache, parallel
+from utils.reader import Labels
+from utils.writer import write_png
+
+
+def shard_prefix(folder):
+    return os.path.relpath(folder, config.data_directory).replace("/", "_")
+
+
+def shard_path(prefix, shard, ext):
+    return os.path.join(config.export_directory, "{}_{:05d}.{}".format(prefix, shard, ext))
+
+
+def load_state(prefix):
+    try:
+        with open(os.path.join(config.export_directory, prefix + ".json")) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_state(prefix, state):
+    path = os.path.join(config.export_directory, prefix + ".json")
+    with open(path + ".part", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + ".part", path)
+
+
+def frame_files(folder, name):
+    # the pngs are copied as they are, only when resizing they are decoded and encoded again
+    color_path, label_path = os.path.join(folder, "color", name), os.path.join(folder, "label_clean", name)
+    if not config.export_size:
+        with open(color_path, "rb") as color, open(label_path, "rb") as label:
+            return color.read(), label.read()
+
+    color = cv2.resize(cv2.imread(color_path), tuple(config.export_size), interpolation=cv2.INTER_AREA)
+    label = np.asarray(Image.open(label_path))
+    label = cv2.resize(label, tuple(config.export_size), interpolation=cv2.INTER_NEAREST)
+    label_file = io.BytesIO()
+    write_png(label, label_file, config.png_compression)
+    return cv2.imencode(".png", color, [cv2.IMWRITE_PNG_COMPRESSION, config.png_compression])[1].tobytes(), \
+        label_file.getvalue()
+
+
+def add_file(tar, name, data):
+    # returns the offset and size of the file's data in the tar, its headers come first
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    offset = tar.offset + len(info.tobuf(tar.format, tar.encoding, tar.errors))
+    tar.addfile(info, io.BytesIO(data))
+    return [offset, len(data)]
+
+
+def write_shard(folder, prefix, shard, names, index):
+    # appends the frames to the shard, index maps every frame in the shard to the offset and size of its
+    # color and label png in the tar
+    mode = "a" if os.path.exists(shard_path(prefix, shard, "tar")) else "w"
+    with tarfile.open(shard_path(prefix, shard, "tar"), mode) as tar:
+        for name in names:
+            key = os.path.splitext(name)[0]
+            color, label = frame_files(folder, name)
+            index[name] = {"color": add_file(tar, key + ".color.png", color),
+                           "label": add_file(tar, key + ".label.png", label)}
+
+    with open(shard_path(prefix, shard, "json"), "w") as f:
+        json.dump(index, f, indent=2)
+
+
+def export_dataset(folder):
+    prefix = shard_prefix(folder)
+    good, _ = Labels(folder).load_good_bad_index()
+    version = cache.version("clean", folder)
+    size = list(config.export_size) if config.export_size else None
+
+    # the shards are written again when the masks changed, when frames were dropped from good.txt
+    # or when the export resolution changed
+    state = load_state(prefix)
+    exported = {x for shard in state["shards"] for x in shard["frames"]} if state else set()
+    if state is None or state["version"] != version or state["size"] != size or not exported <= good:
+        for x in glob.glob(os.path.join(config.export_directory, prefix + "_[0-9][0-9][0-9][0-9][0-9].*")):
+            os.remove(x)
+        state = {"version": version, "size": size, "shards": []}
+        exported = set()
+
+    new = sorted(good - exported)
+    while new:
+        # the last shard is filled up before a new one is started
+        if state["shards"] and len(state["shards"][-1]["frames"]) < config.export_shard_frames:
+            shard = state["shards"][-1]
+        else:
+            shard = {"file": os.path.basename(shard_path(prefix, len(state["shards"]), "tar")), "frames": []}
+            state["shards"].append(shard)
+
+        number = len(state["shards"]) - 1
+        free = config.export_shard_frames - len(shard["frames"])
+        names, new = new[:free], new[free:]
+        index = {}
+        if os.path.exists(shard_path(prefix, number, "json")):
+            with open(shard_path(prefix, number, "json")) as f:
+                index = json.load(f)
+        write_shard(folder, prefix, number, names, index)
+        shard["frames"] += names
+        save_state(prefix, state)
+
+    return folder, len(good - exported), len(good)
+
+
+def find_reviewed():
+    # datasets which went through the review of step 7
+    folders = [os.path.dirname(x) for x in glob.glob(os.path.join(config.data_directory, "**/label_clean"))]
+    return sorted(x for x in folders if os.path.exists(os.path.join(x, "good.txt")))
+
+
+def export_all(jobs=None):
+    os.makedirs(config.export_directory, exist_ok=True)
+    for folder, added, total in parallel.imap(export_dataset, find_reviewed(), jobs or config.jobs):
+        print("exported {} new of {} good frames of {}".format(added, total, folder))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=config.jobs, help="number of datasets exported at once")
+    args = parser.parse_args()
+    export_all(args.jobs)
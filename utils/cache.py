@@ -0,0 +1,129 @@
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import uuid
+
+import config
+from utils import storage
+from utils.reader import has_pointclouds
+
+root = os.path.dirname(os.path.abspath(config.__file__))
+
+# source files, config parameters and the stage whose output is read of every stage. A stage is
+# stale when any of them changed since its output was written. Of the shared modules, which mostly read
+# and write the arrays, only the functions and values which change the output are given as
+# "module:attribute"
+reader_sources = ["utils.reader:reproject", "utils.reader:Reader.points"]
+writer_sources = ["utils.writer:palette", "utils.writer:write_png", "utils.writer:write_color"]
+stages = {
+    "reduce": (["step2_reduce_data.py"],
+               ["change_threshold", "sharpest_frame_batch_size", "combine_virtual"], None),
+    "pointclouds": (["step3_calculate_pointclouds.py", "utils.reader:reproject", "utils.reader:Reader.q_matrix"],
+                    ["get_stereo", "pointcloud_storage"], "reduce"),
+    "ransac": (["step4_ransac.py", "utils/plane.py"] + reader_sources,
+               ["ransac_distance_threshold", "ransac_tracking", "tracking_min_inlier_ratio", "voxel_leaf_size",
+                "pack_inliers", "segmenter_backend", "make_segmenter"], "pointclouds"),
+    "masks": (["step5_create_mask.py", "utils/plane.py", "utils.reader:Reader.inlier"] + reader_sources +
+              writer_sources,
+              ["crf_enabled", "crf_inference_count", "crf_label_gt_prob", "crf_mode", "crf_downscale",
+               "crf_band_width", "crf_tile_size", "configure_crf", "fuse_clean", "fused_write_label"], "ransac"),
+    "clean": (["step6_connected_components.py"] + writer_sources,
+              ["min_obstacle_pixel_count"], "masks"),
+}
+
+
+def cache_path(folder):
+    return os.path.join(folder, ".cache.json")
+
+
+def load(folder):
+    try:
+        with open(cache_path(folder)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def has_output(stage, folder):
+    if stage == "reduce":
+        return storage.exists(folder, "color")
+    elif stage == "pointclouds":
+        return has_pointclouds(folder)
+    elif stage == "ransac":
+        return storage.exists(folder, "planes")
+    elif stage == "masks":
+        # step 5 always writes the color images, the label folder is optional when cleaning in step 5
+        return os.path.isdir(os.path.join(folder, "color"))
+    elif stage == "clean":
+        return os.path.isdir(os.path.join(folder, "label_clean"))
+
+
+def parameter(name):
+    value = getattr(config, name)
+    return inspect.getsource(value) if callable(value) else repr(value)
+
+
+def source(name):
+    if ":" not in name:
+        with open(os.path.join(root, name), "rb") as f:
+            return f.read()
+
+    module, attribute = name.split(":")
+    value = importlib.import_module(module)
+    for x in attribute.split("."):
+        value = getattr(value, x)
+    return (inspect.getsource(value) if callable(value) else repr(value)).encode("utf-8")
+
+
+def fingerprint(stage, folder):
+    sources, parameters, upstream = stages[stage]
+    if stage == "masks" and config.fuse_clean:
+        # the connected components are cleaned in step 5 with step6_connected_components.py and its
+        # min_obstacle_pixel_count
+        sources, parameters = sources + stages["clean"][0], parameters + stages["clean"][1]
+
+    h = hashlib.sha1()
+    for x in sources:
+        h.update(source(x))
+    for x in parameters:
+        h.update("{}={}\n".format(x, parameter(x)).encode("utf-8"))
+    if upstream is not None:
+        h.update(str(version(upstream, folder)).encode("utf-8"))
+    return h.hexdigest()
+
+
+def version(stage, folder):
+    # identifies one run of a stage, the fingerprint of the next stage changes whenever this stage ran again.
+    # Outputs written before the cache existed have no recorded run
+    entry = load(folder).get(stage)
+    if entry is None:
+        return "untracked" if has_output(stage, folder) else None
+    return entry["version"]
+
+
+def record(stage, folder):
+    # the only function writing the cache, called once a stage wrote its output
+    value = fingerprint(stage, folder)
+    entries = load(folder)
+    entries[stage] = {"fingerprint": value, "version": uuid.uuid4().hex}
+    with open(cache_path(folder) + ".part", "w") as f:
+        json.dump(entries, f, indent=2)
+    os.replace(cache_path(folder) + ".part", cache_path(folder))
+    return entries[stage]
+
+
+def is_fresh(stage, folder):
+    if not has_output(stage, folder):
+        return False
+    # the reduced chunks are deleted after combining them, so a recording can't be reduced again
+    if stage == "reduce":
+        return True
+
+    entry = load(folder).get(stage)
+    if entry is None:
+        # outputs written before the cache existed are taken as up to date, until the stage before them ran
+        upstream = stages[stage][2]
+        return upstream is None or version(upstream, folder) == "untracked"
+    return entry["fingerprint"] == fingerprint(stage, folder)
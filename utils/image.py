@@ -16,27 +16,30 @@ def blend(image1, mask, color, opacity):
     return cv2.addWeighted(image1, (1. - opacity), (mask_color * 255).astype(np.uint8), opacity, 0)
 
 
-def dice(y_true, prediction, ignore_area):
-    ignore_mask = ignore_area != 0
-    number_pixels = np.count_nonzero(ignore_mask == 0)
-    y_true = y_true.copy()
-    prediction = prediction.copy()
-    y_true[ignore_mask] = 99
-    prediction[ignore_mask] = 98
+def confusion(y_true, prediction, ignore_area=None, classes=2):
+    # confusion matrix of all not ignored pixels in one bincount, rows are the true and columns the predicted
+    # classes. Values which are no class are counted in an additional last row and column
+    index = np.minimum(y_true.ravel(), classes).astype(np.intp) * (classes + 1)
+    index += np.minimum(prediction.ravel(), classes)
+    if ignore_area is not None:
+        index = index[ignore_area.ravel() == 0]
+    return np.bincount(index, minlength=(classes + 1) ** 2).reshape(classes + 1, classes + 1)
+
 
-    intersection0 = np.logical_and(y_true == 0, prediction == 0)
-    union0 = np.logical_or(y_true == 0, prediction == 0)
+def iou(matrix):
+    # intersection over union of every class of a confusion matrix, nan for classes which appear nowhere
+    intersection = np.diag(matrix)[:-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return intersection / (matrix.sum(axis=0)[:-1] + matrix.sum(axis=1)[:-1] - intersection)
 
-    intersection1 = np.logical_and(y_true == 1, prediction == 1)
-    union1 = np.logical_or(y_true == 1, prediction == 1)
 
-    iou0 = np.sum(intersection0) / np.sum(union0)
-    iou1 = np.sum(intersection1) / np.sum(union1)
+def dice_score(matrix):
+    intersection = np.diag(matrix)[:-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return 2 * intersection / (matrix.sum(axis=0)[:-1] + matrix.sum(axis=1)[:-1])
 
-    # while True:
-    #    cv2.imshow("iou", intersection1.astype(np.float32))
-    #    cv2.waitKey(0)
-    #    cv2.imshow("iou", union1.astype(np.float32))
-    #    cv2.waitKey(0)
 
-    return iou0, iou1, number_pixels / (1.0 * (y_true.shape[0] * y_true.shape[1]))
+def dice(y_true, prediction, ignore_area):
+    matrix = confusion(y_true, prediction, ignore_area)
+    iou0, iou1 = iou(matrix)
+    return iou0, iou1, matrix.sum() / (1.0 * (y_true.shape[0] * y_true.shape[1]))
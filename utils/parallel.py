@@ -0,0 +1,20 @@
+import multiprocessing
+import os
+
+
+def job_count(jobs=None):
+    return jobs or os.cpu_count() or 1
+
+
+def imap(func, tasks, jobs=None, initializer=None, initargs=(), chunksize=1):
+    # yields results in the order of tasks, with a single job everything runs in this process
+    # which keeps debugging (and the cv2.imshow debug views) working
+    if job_count(jobs) == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for task in tasks:
+            yield func(task)
+        return
+
+    with multiprocessing.Pool(job_count(jobs), initializer, initargs) as pool:
+        yield from pool.imap(func, tasks, chunksize)
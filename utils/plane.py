@@ -0,0 +1,126 @@
+import numpy as np
+
+
+def augment(xyzs):
+    axyz = np.ones(xyzs.shape[:-1] + (4,), dtype=np.float32)
+    axyz[..., :3] = xyzs
+    return axyz
+
+
+def estimate(xyzs):
+    # planes through batches of augmented points of shape H x k x 4, scaled to a unit normal
+    models = np.linalg.svd(xyzs)[-1][..., -1, :]
+    norm = np.linalg.norm(models[..., :3], axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return models / norm
+
+
+def refine(xyzs):
+    # least squares plane through the points
+    centroid = np.mean(xyzs, axis=0, dtype=np.float64)
+    normal = np.linalg.eigh(np.cov(xyzs, rowvar=False))[1][:, 0]
+    return np.append(normal, -normal.dot(centroid))
+
+
+def orient(model, reference=None):
+    # the normal points in the direction of the reference plane's normal, without a reference
+    # towards negative y, which is up for an upright camera
+    if reference is not None:
+        return -model if np.dot(model[:3], reference[:3]) < 0 else model
+    return -model if model[1] > 0 else model
+
+
+def inliers(xyzs, model, threshold):
+    # a zero normal is the model of a failed segmentation, no point lies on it
+    if not np.any(model[:3]):
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.abs(xyzs.dot(model[:3]) + model[3]) < threshold)
+
+
+def voxel_downsample(xyzs, leaf_size):
+    # centroid of the points in each occupied voxel
+    if not len(xyzs):
+        return xyzs
+    keys = np.floor(xyzs / leaf_size).astype(np.int64)
+    keys -= keys.min(axis=0)
+    voxels = np.ravel_multi_index(keys.T, keys.max(axis=0) + 1)
+    _, inverse, counts = np.unique(voxels, return_inverse=True, return_counts=True)
+    centroids = np.ndarray(shape=(len(counts), 3), dtype=np.float32)
+    for x in range(3):
+        centroids[:, x] = np.bincount(inverse, weights=xyzs[:, x], minlength=len(counts)) / counts
+    return centroids
+
+
+class PlaneSegmenter:
+    # RANSAC plane segmentation with the interface of python-pcl's segmenters. All hypotheses are
+    # estimated with one batched SVD and scored together on a random subsample of the cloud
+    def __init__(self, coords):
+        self.coords = np.asarray(coords, dtype=np.float32)
+        self.max_iterations = 50
+        self.distance_threshold = 0.03
+        self.optimize_coefficients = True
+        self.sample_count = 20000
+        self.axis = None
+        self.eps_angle = 0.
+        self.random_seed = None
+
+    def set_max_iterations(self, iterations):
+        self.max_iterations = iterations
+
+    def set_distance_threshold(self, threshold):
+        self.distance_threshold = threshold
+
+    def set_optimize_coefficients(self, optimize):
+        self.optimize_coefficients = optimize
+
+    def set_sample_count(self, count):
+        self.sample_count = count
+
+    def set_axis(self, x, y, z):
+        self.axis = np.array([x, y, z], dtype=np.float32) / np.linalg.norm([x, y, z])
+
+    def set_eps_angle(self, angle):
+        self.eps_angle = angle
+
+    def set_random_seed(self, seed):
+        self.random_seed = seed
+
+    def hypotheses(self, sample, rng):
+        models = estimate(augment(sample[rng.integers(0, len(sample), size=(self.max_iterations, 3))]))
+        good = np.all(np.isfinite(models), axis=1)
+
+        # only planes whose normal is within eps_angle of the axis
+        if self.axis is not None:
+            good[good] = np.abs(models[good, :3].dot(self.axis)) >= np.cos(self.eps_angle)
+        return models[good]
+
+    def score(self, sample, models):
+        # inlier counts of all models, in blocks of models to bound the size of the distance matrix
+        sample = augment(sample)
+        block = max(1, (1 << 24) // len(sample))
+        counts = np.zeros(len(models), dtype=np.int64)
+        for x in range(0, len(models), block):
+            distances = np.abs(sample.dot(models[x:x + block].T.astype(np.float32)))
+            counts[x:x + block] = np.count_nonzero(distances < self.distance_threshold, axis=0)
+        return counts
+
+    def segment(self):
+        if len(self.coords) < 3:
+            return np.zeros(0, dtype=np.int64), [0., 0., 0., 0.]
+
+        rng = np.random.default_rng(self.random_seed)
+        sample = self.coords
+        if len(sample) > self.sample_count:
+            sample = sample[rng.integers(0, len(sample), size=self.sample_count)]
+
+        models = self.hypotheses(sample, rng)
+        if not len(models):
+            return np.zeros(0, dtype=np.int64), [0., 0., 0., 0.]
+
+        model = models[np.argmax(self.score(sample, models))]
+        indices = inliers(self.coords, model, self.distance_threshold)
+        if self.optimize_coefficients and len(indices) >= 3:
+            model = refine(self.coords[indices])
+            indices = inliers(self.coords, model, self.distance_threshold)
+
+        return indices, orient(model).tolist()
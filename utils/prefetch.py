@@ -0,0 +1,89 @@
+import threading
+from collections import OrderedDict
+
+import cv2
+
+
+def render_views(labels, name):
+    # the three mask_mode views of step 7: color and cleaned label blended, only color, only the label
+    color = labels.color(name=name)
+    label = labels.label(name=name, cleaned=True)
+    return [cv2.addWeighted(color, 0.5, label, 0.5, 0), color, label]
+
+
+class FrameCache:
+    # keeps the rendered views of the last cache_size frames and renders the frames passed to prefetch
+    # in a background thread. A frame which is neither cached nor being rendered is rendered by get itself
+    def __init__(self, labels, cache_size=32):
+        self.labels = labels
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.wanted = []
+        self.loading = set()
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def store(self, name, views):
+        self.cache[name] = views
+        self.cache.move_to_end(name)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def next_wanted(self):
+        while not self.closed:
+            while self.wanted:
+                name = self.wanted.pop(0)
+                if name not in self.cache and name not in self.loading:
+                    return name
+            self.condition.wait()
+
+    def run(self):
+        while True:
+            with self.condition:
+                name = self.next_wanted()
+                if name is None:
+                    return
+                self.loading.add(name)
+
+            try:
+                views = render_views(self.labels, name)
+            except Exception:
+                # a frame which can't be read is rendered again by get, which then raises the error
+                views = None
+
+            with self.condition:
+                self.loading.discard(name)
+                if views is not None:
+                    self.store(name, views)
+                self.condition.notify_all()
+
+    def get(self, name, mode):
+        with self.condition:
+            while name in self.loading:
+                self.condition.wait()
+            if name in self.cache:
+                self.cache.move_to_end(name)
+                return self.cache[name][mode]
+
+        views = render_views(self.labels, name)
+        with self.condition:
+            self.store(name, views)
+        return views[mode]
+
+    def prefetch(self, names):
+        # replaces the frames still waiting to be rendered, the nearest frames come first. Frames which are
+        # already cached count as recently used, so they are not evicted before the frames rendered now
+        with self.condition:
+            for name in reversed(names):
+                if name in self.cache:
+                    self.cache.move_to_end(name)
+            self.wanted = list(names)
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
@@ -1,12 +1,32 @@
 from __future__ import print_function, unicode_literals
 
 import glob
+import json
 import os
 import pickle
+from collections import OrderedDict
+from types import SimpleNamespace
 
 import cv2
 import numpy as np
 
+from utils import storage
+
+
+def reproject(disparity, Q):
+    disp = disparity.astype(np.float32) * (1 / 16.0)
+    coords = cv2.reprojectImageTo3D(disp, Q, ddepth=cv2.CV_32FC3).reshape(-1, 3)
+    valid = np.logical_and(np.all(np.isfinite(coords), axis=1), np.logical_and(coords[:, 2] >= 0, coords[:, 2] <= 10))
+    return coords, valid
+
+
+def has_pointclouds(folder):
+    return storage.exists(folder, "coords") or storage.exists(folder, "disparity")
+
+
+def find_pointclouds(directory):
+    return sorted(set(storage.find(directory, "coords")) | set(storage.find(directory, "disparity")))
+
 
 class Reader:
     camera_color = camera_infra1 = camera_infra2 = camera_depth = dict()
@@ -32,18 +52,64 @@ class Reader:
             data["translation"] = np.array(data["translation"])
             setattr(self, x, data)
 
+    def q_matrix(self):
+        K = self.camera_infra1["K"]
+        cx, cy, f = K[0, 2], K[1, 2], K[0, 0]
+        Tx = -self.depth_to_infra2["translation"][0]
+        return np.array((
+            (1, 0, 0, -cx),
+            (0, 1, 0, -cy),
+            (0, 0, 0, f),
+            (0, 0, 1 / Tx, 0)
+        ))
+
+    def points(self, i):
+        # valid points of a frame and their pixel index in the infrared image
+        if hasattr(self, "coords"):
+            coords = self.coords[i, ...]
+            valid = (np.logical_not(np.any(np.isnan(coords), axis=1)))
+        else:
+            coords, valid = reproject(self.disparity[i, ...], self.Q)
+        pixels = np.flatnonzero(valid)
+        return coords[pixels, :], pixels
+
+    def pixel_count(self):
+        if hasattr(self, "coords"):
+            return self.coords.shape[1]
+        return self.disparity.shape[1] * self.disparity.shape[2]
+
     def coords_not_nan(self, i):
-        coords = self.coords[i, ...]
-        nan_map = (np.logical_not(np.any(np.isnan(coords), axis=1)))
-        return coords[nan_map, :]
+        return self.points(i)[0]
 
     def model(self, i):
         return self.planes[i, ...]
 
     def inlier(self, i):
+        if hasattr(self, "good_idx_packed"):
+            return np.where(np.unpackbits(self.good_idx_packed[i, :]))
         return np.where(self.good_idx[i, :])
 
-    def __init__(self, folder, infra=True, color=True, coords=False, planes=False, suffix=""):
+    def count(self):
+        for x in ["color", "infra1", "coords", "disparity", "planes"]:
+            if hasattr(self, x):
+                return getattr(self, x).shape[0]
+        return 0
+
+    def frames(self, start=0, stop=None):
+        stop = self.count() if stop is None else min(stop, self.count())
+        for i in range(start, stop):
+            frame = SimpleNamespace(i=i)
+            for x in ["color", "infra1", "infra2"]:
+                if hasattr(self, x):
+                    setattr(frame, x, getattr(self, x)[i, ...])
+            if hasattr(self, "coords") or hasattr(self, "disparity"):
+                frame.coords, frame.pixels = self.points(i)
+            if hasattr(self, "planes"):
+                frame.plane = self.model(i)
+                frame.inlier = self.inlier(i)
+            yield frame
+
+    def __init__(self, folder, infra=True, color=True, coords=False, planes=False, suffix="", mmap_mode=None):
         self.folder = folder
         self.load_camera_info()
         self.load_extrinsics()
@@ -52,34 +118,121 @@ class Reader:
         self.below_is_obstacle = os.path.exists(self.folder + "/below_nok")
 
         if infra:
-            self.infra1 = np.load(self.path("infra1" + suffix, ext="npy"), allow_pickle=True, encoding="bytes")
-            self.infra2 = np.load(self.path("infra2" + suffix, ext="npy"), allow_pickle=True, encoding="bytes")
+            self.infra1 = storage.load(self.folder, "infra1" + suffix, mmap_mode)
+            self.infra2 = storage.load(self.folder, "infra2" + suffix, mmap_mode)
 
         if color:
-            self.color = np.load(self.path("color" + suffix, ext="npy"), allow_pickle=True, encoding="bytes")
+            self.color = storage.load(self.folder, "color" + suffix, mmap_mode)
 
         if coords:
-            self.coords = np.load(self.path("coords" + suffix, ext="npy"), allow_pickle=True, encoding="bytes")
+            if storage.exists(self.folder, "coords" + suffix):
+                self.coords = storage.load(self.folder, "coords" + suffix, mmap_mode)
+            else:
+                self.disparity = storage.load(self.folder, "disparity" + suffix, mmap_mode)
+                self.Q = storage.load(self.folder, "q_matrix" + suffix)
 
         if planes:
-            self.planes = np.load(self.path("planes" + suffix, ext="npy"), allow_pickle=True, encoding="bytes")
-            self.good_idx = np.load(self.path("good_idx" + suffix, ext="npy"), allow_pickle=True, encoding="bytes")
+            self.planes = storage.load(self.folder, "planes" + suffix, mmap_mode)
+            if storage.exists(self.folder, "good_idx_packed" + suffix):
+                self.good_idx_packed = storage.load(self.folder, "good_idx_packed" + suffix, mmap_mode)
+            else:
+                self.good_idx = storage.load(self.folder, "good_idx" + suffix, mmap_mode)
+
+    def close(self):
+        # a Reader of the main process is closed before the worker pool is started
+        for x in ["infra1", "infra2", "color", "coords", "disparity", "planes", "good_idx_packed", "good_idx"]:
+            if hasattr(self, x):
+                storage.close(getattr(self, x))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 class Labels:
     def __init__(self, folder):
         self.folder = folder
+        self.entries = None
 
     def path(self, *p, **kwargs):
         ext = kwargs.get("ext")
         return os.path.realpath(os.path.join(self.folder, *p) + (("." + ext) if ext else ""))
 
+    # manifest.jsonl lists the frames of the dataset, every line holds fields of one frame and later lines
+    # update the fields of earlier ones: index and height / width of a mask written by step 5, cleaned once
+    # step 6 cleaned it and review with the "good" or "bad" decision of step 7, stale once the mask was
+    # calculated again after the decision
+    def manifest(self):
+        if self.entries is None:
+            if not os.path.exists(self.path("manifest.jsonl")):
+                self.build_manifest()
+
+            self.entries = OrderedDict()
+            with open(self.path("manifest.jsonl")) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a line cut off by an interrupted step
+                        continue
+                    self.entries.setdefault(record["name"], {}).update(record)
+        return self.entries
+
+    def build_manifest(self):
+        # datasets labeled before the manifest existed are listed once from their color folder
+        from PIL import Image
+
+        good, bad = self.load_good_bad_files()
+        records = []
+        for x in sorted(glob.glob(self.path("color/*.png"))):
+            name = os.path.basename(x)
+            width, height = Image.open(x).size
+            record = {"name": name, "index": int(name[:-4].split("_")[-1]), "height": height, "width": width}
+            if os.path.exists(self.path("label_clean", name)):
+                record["cleaned"] = True
+            if name in good or name in bad:
+                record["review"] = "good" if name in good else "bad"
+            records.append(record)
+        self.write_manifest(records, "w")
+
+    def write_manifest(self, records, mode="a"):
+        with open(self.path("manifest.jsonl"), mode) as f:
+            f.writelines(json.dumps(x) + "\n" for x in records)
+
+        if mode == "w":
+            self.entries = None
+        elif self.entries is not None:
+            for record in records:
+                self.entries.setdefault(record["name"], {}).update(record)
+
+    def add_frame(self, name, index, shape, cleaned=False):
+        record = {"name": name, "index": int(index), "height": int(shape[0]), "width": int(shape[1])}
+        if cleaned:
+            record["cleaned"] = True
+        self.write_manifest([record])
+
+    def update(self, name, **fields):
+        fields["name"] = name
+        self.write_manifest([fields])
+
+    def reset_manifest(self):
+        # drops the frames before the masks are calculated again. The review decisions are kept, but as they
+        # were made on the old masks they are marked stale, so step 7 shows these frames again
+        records = [{"name": x["name"], "review": x["review"], "stale": True}
+                   for x in self.manifest().values() if x.get("review")]
+        self.write_manifest(records, "w")
+
+    def frames(self):
+        return [x for x in self.manifest().values() if "index" in x]
+
     def count(self):
-        return len(glob.glob(self.path("color/*.png")))
+        return len(self.frames())
 
     def names(self):
-        for x in glob.glob(self.path("color/*.png")):
-            yield x.split("/")[-1]
+        for x in self.frames():
+            yield x["name"]
 
     def label(self, i=0, cleaned=False, name=None):
 
@@ -93,11 +246,17 @@ class Labels:
             return cv2.imread(self.path(folder, os.path.basename(self.folder) + "_%05d.png" % i))
 
     def load_good_bad_index(self):
+        reviews = [(x["name"], x.get("review")) for x in self.manifest().values()]
+        return {x for x, review in reviews if review == "good"}, {x for x, review in reviews if review == "bad"}
+
+    def stale_reviews(self):
+        return {x["name"] for x in self.manifest().values() if x.get("review") and x.get("stale")}
+
+    def load_good_bad_files(self):
         try:
             with open(self.path("good.txt")) as f:
                 good = {x for x in f.read().splitlines(keepends=False) if x}
         except FileNotFoundError:
-            print(self.path("good.txt"))
             good = set()
 
         try:
@@ -109,6 +268,13 @@ class Labels:
         return good, bad
 
     def save_good_bad_index(self, good, bad):
+        # the manifest is updated for the changed decisions, good.txt and bad.txt are exported for
+        # collecting the training data
+        old_good, old_bad = self.load_good_bad_index()
+        self.write_manifest([{"name": x, "review": "good"} for x in sorted(good - old_good)] +
+                            [{"name": x, "review": "bad"} for x in sorted(bad - old_bad)] +
+                            [{"name": x, "review": None} for x in sorted((old_good | old_bad) - good - bad)])
+
         with open(self.path("good.txt"), "w") as f:
             f.writelines([x+"\n" for x in good])
         with open(self.path("bad.txt"), "w") as f:
@@ -0,0 +1,357 @@
+from __future__ import print_function, unicode_literals
+
+import glob
+import json
+import os
+import struct
+from contextlib import contextmanager
+
+import numpy as np
+
+import config
+
+# fixed size of the .npy header written by NpyWriter, large enough for any frame stack
+# and a multiple of 64 so the data stays aligned for memory mapping
+_HEADER_SIZE = 128
+
+# os.replace is missing in python 2, where os.rename replaces existing files on posix as well
+_replace = getattr(os, "replace", os.rename)
+
+# frames smaller than this are grouped into one hdf5 chunk, bigger frames get a chunk each
+_CHUNK_BYTES = 1 << 16
+
+
+def _npy_header(shape, dtype):
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+        np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(int(x) for x in shape))
+    header = header.ljust(_HEADER_SIZE - 11) + "\n"
+    return np.lib.format.magic(1, 0) + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+def array_path(folder, name):
+    return os.path.join(folder, name) + ".npy"
+
+
+def h5_path(folder, name):
+    return os.path.join(folder, name) + ".h5"
+
+
+def stored_path(folder, name):
+    # path of the array in whichever format it was written, new arrays are written in config.storage_backend
+    if os.path.exists(array_path(folder, name)):
+        return array_path(folder, name)
+    if os.path.exists(h5_path(folder, name)):
+        return h5_path(folder, name)
+    return h5_path(folder, name) if config.storage_backend == "hdf5" else array_path(folder, name)
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _output_path(folder, name):
+    if config.storage_backend == "hdf5":
+        return h5_path(folder, name)
+    return array_path(folder, name)
+
+
+def _other_path(path):
+    # an array written in one format replaces the array in the other format, which is only removed
+    # once the new one was written completely
+    return path[:-len(".h5")] + ".npy" if path.endswith(".h5") else path[:-len(".npy")] + ".h5"
+
+
+def _compression():
+    if config.hdf5_compression == "blosc":
+        try:
+            import hdf5plugin
+            return dict(hdf5plugin.Blosc(cname="lz4", clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+        except ImportError:
+            pass
+    if config.hdf5_compression:
+        return {"compression": "lzf", "shuffle": True}
+    return {}
+
+
+def _h5_options(shape, dtype):
+    # frame stacks are chunked along the first axis, so reading a frame only decodes the chunk of that frame
+    if len(shape) < 2 or 0 in shape:
+        return {}
+
+    frame_bytes = int(np.prod(shape[1:])) * np.dtype(dtype).itemsize
+    frames = max(1, _CHUNK_BYTES // max(frame_bytes, 1))
+    if shape[0] is not None:
+        frames = min(frames, shape[0])
+
+    options = {"chunks": (frames,) + tuple(shape[1:])}
+    options.update(_compression())
+    return options
+
+
+def _load_h5(path, name, mmap_mode=None):
+    import h5py
+
+    # like a memory mapped .npy, with a mmap_mode the frames are only read when they are accessed. The file
+    # stays open until the dataset is passed to close
+    if mmap_mode:
+        return h5py.File(path, "r")[name]
+    with h5py.File(path, "r") as f:
+        return f[name][()]
+
+
+def _load_path(path, name, mmap_mode=None):
+    if path.endswith(".h5"):
+        return _load_h5(path, name, mmap_mode)
+    # arrays written by older versions with ndarray.dump are pickles, those are always read into memory
+    return np.load(path, mmap_mode=mmap_mode, allow_pickle=True, encoding="bytes")
+
+
+def virtual_path(folder):
+    return os.path.join(folder, "virtual.json")
+
+
+def load_virtual(folder):
+    try:
+        with open(virtual_path(folder)) as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return {}
+
+
+def save_virtual(folder, arrays):
+    # arrays maps an array name to the (folder, name) pairs of the arrays it is stacked from
+    manifest = {x: [os.path.relpath(stored_path(*part), folder) for part in parts] for x, parts in arrays.items()}
+    with open(virtual_path(folder), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+class VirtualStack(object):
+    # presents the arrays of several chunks as one stack along the first axis without copying them
+    def __init__(self, parts):
+        self.parts = parts
+        self.offsets = np.cumsum([0] + [len(x) for x in parts])
+        self.shape = (int(self.offsets[-1]),) + parts[0].shape[1:]
+        self.dtype = parts[0].dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return np.concatenate(self.parts, axis=0).astype(dtype or self.dtype, copy=False)
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError("index {} is out of bounds for {} frames".format(key, len(self)))
+            part = np.searchsorted(self.offsets, key, side="right") - 1
+            return self.parts[part][(key - self.offsets[part],) + rest]
+
+        indices = np.arange(len(self))[key]
+        if not len(indices):
+            return self.parts[0][(slice(0, 0),) + rest]
+        return np.stack([self[(int(i),) + rest] for i in indices])
+
+
+class NpyWriter(object):
+    # the frames are written to a part file, which only replaces path when the writer is closed without
+    # an error. An interrupted writer leaves no array behind which looks complete
+    def __init__(self, path, replaces=None):
+        self.path = path
+        self.replaces = replaces
+        self.count = 0
+        self.shape = None
+        self.dtype = None
+        self.file = open(path + ".part", "wb")
+
+    def append(self, frame):
+        frame = np.ascontiguousarray(frame)
+        if self.shape is None:
+            self.shape, self.dtype = frame.shape, frame.dtype
+            self.file.write(_npy_header((0,) + self.shape, self.dtype))
+        elif frame.shape != self.shape or frame.dtype != self.dtype:
+            raise ValueError("frame {} {} does not match {} {} of {}".format(
+                frame.shape, frame.dtype, self.shape, self.dtype, self.path))
+
+        self.file.write(frame.tobytes())
+        self.count += 1
+
+    def close(self):
+        if self.file.closed:
+            return
+
+        # the header is rewritten in place once the final frame count is known
+        if self.shape is None:
+            self.file.write(_npy_header((0,), np.float64))
+        else:
+            self.file.seek(0)
+            self.file.write(_npy_header((self.count,) + self.shape, self.dtype))
+        self.file.close()
+        _replace(self.path + ".part", self.path)
+        if self.replaces:
+            _remove(self.replaces)
+
+    def discard(self):
+        if not self.file.closed:
+            self.file.close()
+        _remove(self.path + ".part")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class H5Writer(object):
+    # hdf5 counterpart of NpyWriter, the dataset is resized by one frame per append and written to a part
+    # file as well
+    def __init__(self, path, name, replaces=None):
+        import h5py
+
+        self.path = path
+        self.name = name
+        self.replaces = replaces
+        self.count = 0
+        self.data = None
+        self.file = h5py.File(path + ".part", "w")
+
+    def append(self, frame):
+        frame = np.asarray(frame)
+        if self.data is None:
+            self.data = self.file.create_dataset(self.name, shape=(0,) + frame.shape, maxshape=(None,) + frame.shape,
+                                                 dtype=frame.dtype, **_h5_options((None,) + frame.shape, frame.dtype))
+        elif frame.shape != self.data.shape[1:] or frame.dtype != self.data.dtype:
+            raise ValueError("frame {} {} does not match {} {} of {}".format(
+                frame.shape, frame.dtype, self.data.shape[1:], self.data.dtype, self.path))
+
+        self.data.resize(self.count + 1, axis=0)
+        self.data[self.count] = frame
+        self.count += 1
+
+    def close(self):
+        if self.file is None:
+            return
+
+        if self.data is None:
+            self.file.create_dataset(self.name, shape=(0,), dtype=np.float64)
+        self.file.close()
+        self.file = None
+        _replace(self.path + ".part", self.path)
+        if self.replaces:
+            _remove(self.replaces)
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        _remove(self.path + ".part")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def writer(folder, name):
+    path = _output_path(folder, name)
+    if path.endswith(".h5"):
+        return H5Writer(path, name, replaces=_other_path(path))
+    return NpyWriter(path, replaces=_other_path(path))
+
+
+def exists(folder, name):
+    return os.path.exists(array_path(folder, name)) or os.path.exists(h5_path(folder, name)) \
+        or name in load_virtual(folder)
+
+
+def find(directory, name):
+    folders = set()
+    for ext in [".npy", ".h5"]:
+        folders |= {os.path.dirname(x) for x in glob.glob(os.path.join(directory, "**", name + ext))}
+    for x in glob.glob(os.path.join(directory, "**", "virtual.json")):
+        if name in load_virtual(os.path.dirname(x)):
+            folders.add(os.path.dirname(x))
+    return sorted(folders)
+
+
+def load(folder, name, mmap_mode=None):
+    path = stored_path(folder, name)
+    manifest = load_virtual(folder)
+    if not os.path.exists(path) and name in manifest:
+        # the parts are named like the arrays they were stacked from
+        return VirtualStack([_load_path(os.path.join(folder, x), os.path.splitext(os.path.basename(x))[0],
+                                        mmap_mode) for x in manifest[name]])
+    return _load_path(path, name, mmap_mode)
+
+
+def close(array):
+    # closes the hdf5 file of an array loaded with a mmap_mode, memory maps are released with the array.
+    # Open files must not be inherited by forked worker processes, those load the arrays themselves
+    if isinstance(array, VirtualStack):
+        for x in array.parts:
+            close(x)
+    elif getattr(array, "id", None) is not None and array.id.valid:
+        array.file.close()
+
+
+def save(folder, name, array):
+    path = _output_path(folder, name)
+    if not path.endswith(".h5"):
+        np.save(path, array, allow_pickle=False)
+    else:
+        import h5py
+        array = np.asarray(array)
+        with h5py.File(path + ".part", "w") as f:
+            f.create_dataset(name, data=array, **_h5_options(array.shape, array.dtype))
+        os.replace(path + ".part", path)
+    _remove(_other_path(path))
+
+
+@contextmanager
+def create(folder, name, shape, dtype):
+    # preallocated array on disk which is filled slice by slice, it only replaces an existing
+    # array once it was written completely
+    path = _output_path(folder, name)
+    if path.endswith(".h5"):
+        import h5py
+        f = h5py.File(path + ".part", "w")
+        array = f.create_dataset(name, shape=tuple(shape), dtype=dtype, **_h5_options(tuple(shape), dtype))
+    else:
+        f = None
+        array = np.lib.format.open_memmap(path + ".part", mode="w+", dtype=dtype, shape=tuple(shape))
+
+    try:
+        yield array
+        if f is None:
+            array.flush()
+    except BaseException:
+        del array
+        if f is not None:
+            f.close()
+        os.remove(path + ".part")
+        raise
+    del array
+    if f is not None:
+        f.close()
+    os.replace(path + ".part", path)
+    _remove(_other_path(path))
+
+
+def delete(folder, name):
+    _remove(array_path(folder, name))
+    _remove(h5_path(folder, name))
@@ -0,0 +1,101 @@
+from __future__ import print_function, unicode_literals
+
+import cProfile
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+import config
+
+clock = getattr(time, "perf_counter", time.time)
+
+
+def current_rss():
+    # resident memory of this process in MB, None where /proc is not available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024. ** 2
+    except (IOError, OSError):
+        return None
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class Trace(object):
+    # wall time of the phases and counts of one frame, or of one batch of frames. Traces are created in
+    # the worker processes and their records are written by the main process. start is the clock() the
+    # frame's work began at, if it began before the trace was created
+    def __init__(self, stage, frame=None, start=None):
+        self.record = {"stage": stage, "frame": frame, "phases": {}, "counts": {}}
+        self.start = clock() if start is None else start
+
+    @contextmanager
+    def phase(self, name):
+        start = clock()
+        try:
+            yield
+        finally:
+            self.add(name, clock() - start)
+
+    def add(self, name, seconds):
+        self.record["phases"][name] = self.record["phases"].get(name, 0.) + seconds
+
+    def count(self, name, value):
+        self.record["counts"][name] = int(value)
+
+    def finish(self):
+        self.record["seconds"] = clock() - self.start
+        self.record["rss_mb"] = current_rss()
+        self.record["peak_rss_mb"] = peak_rss()
+        return self.record
+
+
+class TraceWriter(object):
+    # appends the records of one run of a stage to trace.jsonl in the dataset folder, framed by a start
+    # and an end record. Nothing is written unless config.trace_enabled is set
+    def __init__(self, folder, stage):
+        self.stage = stage
+        self.file = None
+        if config.trace_enabled:
+            self.file = open(os.path.join(folder, "trace.jsonl"), "a")
+            self.start = clock()
+            self.write({"stage": stage, "event": "start", "time": time.time()})
+
+    def write(self, record):
+        if self.file is not None:
+            self.file.write(json.dumps(record) + "\n")
+
+    def close(self):
+        if self.file is not None:
+            self.write({"stage": self.stage, "event": "end", "seconds": clock() - self.start,
+                        "peak_rss_mb": peak_rss()})
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@contextmanager
+def profile(path):
+    # runs the block under cProfile if config.trace_profile is set and writes the stats to path. Only this
+    # process is profiled, run the step with a single job to include the work of the worker processes
+    if not config.trace_profile:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
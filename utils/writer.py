@@ -0,0 +1,67 @@
+import queue
+import threading
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# index 0 is the ground class, index 1 the obstacle class, everything else (the ignore class 255) is black
+palette = [0, 255, 0, 255, 0, 0] + [0, 0, 0] * 254
+
+
+def write_png(mask, path, compression=6):
+    mask = np.ascontiguousarray(mask.reshape(mask.shape[0], mask.shape[1]), dtype=np.uint8)
+    image = Image.frombytes("P", (mask.shape[1], mask.shape[0]), mask.tobytes())
+    image.putpalette(palette)
+    image.save(path, format="PNG", compress_level=compression)
+
+
+def write_color(image, path, compression=6):
+    cv2.imwrite(path, image, [cv2.IMWRITE_PNG_COMPRESSION, compression])
+
+
+class AsyncWriter:
+    # runs the writes in a background thread. submit only blocks once queue_size writes are waiting,
+    # the first error of a write is raised again by the next submit or by close
+    def __init__(self, queue_size=16):
+        self.queue = queue.Queue(queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+
+            func, args = item
+            if self.error is None:
+                try:
+                    func(*args)
+                except Exception as e:
+                    self.error = e
+            self.queue.task_done()
+
+    def submit(self, func, *args):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((func, args))
+
+    def flush(self):
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()